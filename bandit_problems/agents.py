@@ -3,7 +3,15 @@
 from numpy.random import random, random_integers, normal
 import numpy as np
 
+from lib.sampling import sample, sample_batch
+
 class Agent:
+    """
+    Every agent can either play a single bandit (reset/do_pull) or a whole
+    population of bandits at once (reset_batch/do_pull_batch). In batch mode
+    value estimates are kept as a num_trials x num_arms array and all
+    randomness comes from the numpy Generator passed to reset_batch.
+    """
 
     def __init__(self, num_arms):
         self._num_arms = num_arms
@@ -13,11 +21,24 @@ class Agent:
     def reset(self):
         self._value_estimates = normal(size=(self._num_arms))
         self._results = np.zeros((self._num_arms, 2))
+
+    def reset_batch(self, num_trials, rng=None):
+        self._rng = rng if rng is not None else np.random.default_rng()
+        self._value_estimates = self._rng.normal(size=(num_trials, self._num_arms))
+        self._results = np.zeros((num_trials, self._num_arms, 2))
+        self._rows = np.arange(num_trials)
             
     def _update_value_estimate(self, reward, arm):
         self._results[arm, 0] += reward
         self._results[arm, 1] += 1
         self._value_estimates[arm] = self._results[arm, 0] / self._results[arm, 1]
+
+    def _update_value_estimates(self, rewards, arms):
+        self._results[self._rows, arms, 0] += rewards
+        self._results[self._rows, arms, 1] += 1
+        self._value_estimates[self._rows, arms] = (
+            self._results[self._rows, arms, 0] / self._results[self._rows, arms, 1]
+        )
             
     def do_pull(self, bandit):
         arm = self._choose_arm()
@@ -25,6 +46,17 @@ class Agent:
         self._update_value_estimate(reward, arm)
         return reward, bandit.was_optimal_choice(arm)
 
+    def do_pull_batch(self, bandit):
+        """
+        Pulls one arm of every bandit in a NArmedBanditBatch.
+
+        Returns arrays of rewards and optimal choice flags, one per trial.
+        """
+        arms = self._choose_arms()
+        rewards = bandit.pull_arms(arms)
+        self._update_value_estimates(rewards, arms)
+        return rewards, bandit.was_optimal_choices(arms)
+
 class SoftmaxAgent(Agent):
 
     def __init__(self, temperature, num_arms):
@@ -34,18 +66,27 @@ class SoftmaxAgent(Agent):
     def _gibbs_distribution(self):
         dist = np.exp(self._value_estimates/self._temperature)
         return dist / np.sum(dist)
+
+    def _gibbs_distributions(self):
+        # Subtract the row max so low temperatures don't overflow
+        exponents = self._value_estimates / self._temperature
+        dist = np.exp(exponents - np.max(exponents, axis=1, keepdims=True))
+        return dist / np.sum(dist, axis=1, keepdims=True)
     
     def _get_sample(self, dist):
-        cumulative_dist = np.cumsum(dist)
-        r = random()
-        for i in range(len(cumulative_dist)):
-            if r < cumulative_dist[i]:
-                return i
+        return sample(dist)
+
+    def _get_samples(self, dists):
+        return sample_batch(dists, self._rng)
     
     def _choose_arm(self):
         dist = self._gibbs_distribution()
         return self._get_sample(dist)
 
+    def _choose_arms(self):
+        dists = self._gibbs_distributions()
+        return self._get_samples(dists)
+
     def __str__(self):
         return f'Softmax Agent (t={self._temperature})'
 
@@ -60,6 +101,10 @@ class EpsilonGreedyAgent(Agent):
     def reset(self):
         self._epsilon = self._starting_epsilon
         Agent.reset(self)
+
+    def reset_batch(self, num_trials, rng=None):
+        self._epsilon = self._starting_epsilon
+        Agent.reset_batch(self, num_trials, rng)
     
     def _choose_arm(self):
         if random() < self._epsilon:
@@ -67,6 +112,13 @@ class EpsilonGreedyAgent(Agent):
         else:
             return np.argmax(self._value_estimates)
 
+    def _choose_arms(self):
+        num_trials = self._value_estimates.shape[0]
+        explore = self._rng.random(num_trials) < self._epsilon
+        random_arms = self._rng.integers(0, self._num_arms, size=num_trials)
+        greedy_arms = np.argmax(self._value_estimates, axis=1)
+        return np.where(explore, random_arms, greedy_arms)
+
     def __str__(self):
         return f'Epsilon Greedy Agent (ε={self._epsilon})'
 
@@ -80,6 +132,9 @@ class FixedAlphaEpsilonGreedyAgent(EpsilonGreedyAgent):
     def _update_value_estimate(self, reward, arm):
         self._value_estimates[arm] += self._alpha * (reward - self._value_estimates[arm])
 
+    def _update_value_estimates(self, rewards, arms):
+        self._value_estimates[self._rows, arms] += self._alpha * (rewards - self._value_estimates[self._rows, arms])
+
     def __str__(self):
         return f'Fixed Alpha Epsilon Greedy Agent (ε={self._epsilon}, α={self._alpha})'
 
@@ -94,6 +149,10 @@ class AdjustableEpsilonGreedyAgent(EpsilonGreedyAgent):
     def reset(self):
         self._num_pulls = 0
         EpsilonGreedyAgent.reset(self)
+
+    def reset_batch(self, num_trials, rng=None):
+        self._num_pulls = 0
+        EpsilonGreedyAgent.reset_batch(self, num_trials, rng)
     
     def do_pull(self, bandit):
         self._adjust_epsilon()
@@ -101,6 +160,13 @@ class AdjustableEpsilonGreedyAgent(EpsilonGreedyAgent):
         self._num_pulls += 1
         return reward, was_optimal
 
+    def do_pull_batch(self, bandit):
+        # Every trial is on the same pull, so they all share one epsilon
+        self._adjust_epsilon()
+        rewards, were_optimal = Agent.do_pull_batch(self, bandit)
+        self._num_pulls += 1
+        return rewards, were_optimal
+
 
 class ExponentialDecreaseEpsilonGreedyAgent(AdjustableEpsilonGreedyAgent):
 
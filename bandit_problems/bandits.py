@@ -38,3 +38,56 @@ class MovingNArmedBandit(NArmedBandit):
         value = super(MovingNArmedBandit, self).pull_arm(arm)
         self._arms += self._sigma * randn(len(self._arms))
         return value
+
+
+class NArmedBanditBatch(object):
+    """
+    A population of independent n-armed bandits, one per trial.
+
+    Arm values are stored as a num_trials x n array so that every trial
+    can be pulled at once. All randomness comes from rng, a numpy Generator.
+    """
+
+    def __init__(self, n, num_trials, rng=None):
+        self._rng = rng if rng is not None else np.random.default_rng()
+        self._arms = self._rng.standard_normal((num_trials, n))
+        self._rows = np.arange(num_trials)
+
+    def pull_arms(self, arms):
+        """
+        Pulls one arm per trial. arms is an array of length num_trials.
+        """
+        self.validate_arms(arms)
+        return self._arms[self._rows, arms] + self._rng.standard_normal(len(self._rows))
+
+    def num_arms(self):
+        return self._arms.shape[1]
+
+    def num_trials(self):
+        return self._arms.shape[0]
+
+    def validate_arms(self, arms):
+        if np.any(arms < 0) or np.any(arms >= self.num_arms()):
+            raise ValueError("This arm does not exist.")
+
+    def was_optimal_choices(self, arms):
+        """
+        Tells, for every trial, if the choice was optimal.
+
+        Should be used for analysis purposes only
+        (in other words, not for actually solving the problem)
+        """
+        self.validate_arms(arms)
+        return np.argmax(self._arms, axis=1) == arms
+
+
+class MovingNArmedBanditBatch(NArmedBanditBatch):
+
+    def __init__(self, n, num_trials, sigma=0.1, rng=None):
+        super(MovingNArmedBanditBatch, self).__init__(n, num_trials, rng)
+        self._sigma = sigma
+
+    def pull_arms(self, arms):
+        values = super(MovingNArmedBanditBatch, self).pull_arms(arms)
+        self._arms += self._sigma * self._rng.standard_normal(self._arms.shape)
+        return values
@@ -15,6 +15,14 @@ parser.add_argument('--pulls',
                     type=int,
                     help='Number of pulls per trial',
                     default=3000)
+parser.add_argument('--workers',
+                    type=int,
+                    help='Number of processes to split the trials across',
+                    default=1)
+parser.add_argument('--seed',
+                    type=int,
+                    help='Random seed, for reproducible runs',
+                    default=None)
 args = parser.parse_args()
 
 # Parameters
@@ -28,5 +36,8 @@ agents.append(ExponentialDecreaseEpsilonGreedyAgent(num_arms, num_pulls, decline
 agents.append(SoftmaxAgent(0.3, num_arms))
 
 tb = TestBed(agents, num_arms, num_trials=num_trials, num_pulls=num_pulls)
-tb.run()
+if args.workers > 1:
+    tb.run_parallel(num_workers=args.workers, seed=args.seed)
+else:
+    tb.run_batched(seed=args.seed)
 tb.plot_results(title='Decreasing Epsilon Value')
\ No newline at end of file
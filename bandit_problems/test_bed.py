@@ -1,8 +1,11 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import matplotlib.pyplot as plt
 import numpy as np
 from tqdm import tqdm
 
-from bandit_problems.bandits import NArmedBandit, MovingNArmedBandit
+from bandit_problems.bandits import NArmedBandit, MovingNArmedBandit, NArmedBanditBatch, MovingNArmedBanditBatch
 
 
 class TestBed:
@@ -47,6 +50,54 @@ class TestBed:
                     if was_optimal:
                         self._optimal_choices[i, pull] += 1
 
+    def run_batched(self, seed=None):
+        """
+        Same as run, but plays every trial at once as a single
+        num_trials x num_arms population of bandits.
+        """
+        rng = np.random.default_rng(seed)
+        b = NArmedBanditBatch(self._num_arms, self._num_trials, rng=rng)
+        self._run_batch(b, rng)
+
+    def run_moving_batched(self, seed=None):
+        rng = np.random.default_rng(seed)
+        b = MovingNArmedBanditBatch(self._num_arms, self._num_trials, 0.1, rng=rng)
+        self._run_batch(b, rng)
+
+    def run_parallel(self, num_workers=None, seed=None, moving=False):
+        """
+        Splits the trials across a pool of processes, each of which runs
+        its share with the batched engine, and sums their results.
+
+        Every worker gets its own Generator spawned from seed, so runs with
+        the same seed and number of workers give identical results.
+        """
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        num_workers = max(1, min(num_workers, self._num_trials))
+        worker_seeds = np.random.SeedSequence(seed).spawn(num_workers)
+        worker_trials = [len(chunk) for chunk in np.array_split(np.arange(self._num_trials), num_workers)]
+
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [
+                executor.submit(_run_trials, self._agents, self._num_arms, trials, self._num_pulls, moving, worker_seed)
+                for trials, worker_seed in zip(worker_trials, worker_seeds)
+            ]
+            # Sum in submission order so floating point results don't depend on scheduling
+            for future in tqdm(futures):
+                results, optimal_choices = future.result()
+                self._results += results
+                self._optimal_choices += optimal_choices
+
+    def _run_batch(self, bandit, rng, show_progress=True):
+        for agent in self._agents:
+            agent.reset_batch(self._num_trials, rng)
+        for pull in tqdm(range(self._num_pulls), disable=not show_progress):
+            for i in range(len(self._agents)):
+                rewards, were_optimal = self._agents[i].do_pull_batch(bandit)
+                self._results[i, pull] += np.sum(rewards)
+                self._optimal_choices[i, pull] += np.count_nonzero(were_optimal)
+
     def plot_results(self, title):
         plt.figure(1)
         avgs = self._results / self._num_trials
@@ -67,3 +118,17 @@ class TestBed:
         plt.legend(loc=4)
 
         plt.show()
+
+
+def _run_trials(agents, num_arms, num_trials, num_pulls, moving, seed):
+    """
+    Runs one worker's share of a TestBed.run_parallel call.
+    """
+    rng = np.random.default_rng(seed)
+    tb = TestBed(agents, num_arms, num_trials=num_trials, num_pulls=num_pulls)
+    if moving:
+        b = MovingNArmedBanditBatch(num_arms, num_trials, 0.1, rng=rng)
+    else:
+        b = NArmedBanditBatch(num_arms, num_trials, rng=rng)
+    tb._run_batch(b, rng, show_progress=False)
+    return tb._results, tb._optimal_choices
@@ -2,7 +2,94 @@ import numpy as np
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 import math
-from tqdm import tqdm
+from functools import lru_cache
+
+from lib.mdp import TabularMDP
+
+@lru_cache(maxsize=None)
+def poisson_pmf(expected, size, exact_tail):
+    """
+    Returns P(X = n) for n in [0, size) where X ~ Poisson(expected).
+
+    If exact_tail is True, the last entry holds P(X >= size - 1) instead,
+    so that no probability mass is lost.
+    """
+    pmf = np.empty(size)
+    pmf[0] = math.exp(-expected)
+    pmf[1:] = expected / np.arange(1, size)
+    pmf = np.cumprod(pmf)
+    if exact_tail:
+        pmf[-1] = max(1.0 - pmf[:-1].sum(), 0.0)
+    pmf.setflags(write=False)
+    return pmf
+
+
+@lru_cache(maxsize=None)
+def dealership_transitions(max_cars, expected_requests, expected_returns, poisson_cutoff):
+    """
+    Returns the max_cars x max_cars matrix of probabilities of going from
+    the cars at a dealership after moving to the cars there the next day.
+
+    Requests are served first, then returns come in, and any cars above
+    max_cars - 1 are lost. Memoized, so the result must not be modified.
+    """
+    if poisson_cutoff is None:
+        # Requests >= max_cars - 1 always empty the lot and returns >= max_cars - 1
+        # always fill it, so lumping the tails into the last entry is exact
+        requests_pmf = poisson_pmf(expected_requests, max_cars, True)
+        returns_pmf = poisson_pmf(expected_returns, max_cars, True)
+    else:
+        requests_pmf = poisson_pmf(expected_requests, poisson_cutoff, False)
+        returns_pmf = poisson_pmf(expected_returns, poisson_cutoff, False)
+
+    cars = np.arange(max_cars)
+    after_requests = np.zeros((max_cars, max_cars))
+    requests = np.arange(len(requests_pmf))
+    np.add.at(
+        after_requests,
+        (cars[:, np.newaxis], np.maximum(cars[:, np.newaxis] - requests, 0)),
+        requests_pmf[np.newaxis, :]
+    )
+    after_returns = np.zeros((max_cars, max_cars))
+    returns = np.arange(len(returns_pmf))
+    np.add.at(
+        after_returns,
+        (cars[:, np.newaxis], np.minimum(cars[:, np.newaxis] + returns, max_cars - 1)),
+        returns_pmf[np.newaxis, :]
+    )
+    transitions = np.matmul(after_requests, after_returns)
+    transitions.setflags(write=False)
+    return transitions
+
+
+@lru_cache(maxsize=None)
+def dealership_expected_revenue(max_cars, expected_requests, poisson_cutoff, direction, actions, sale_price):
+    """
+    Returns the len(actions) x max_cars x max_cars array of expected revenue
+    indexed by action, cars before moving, and cars the next day. Actions
+    move direction * action cars onto this dealership and are indexed like
+    a list, so negative actions wrap around. Moves that would leave fewer
+    than 0 cars earn nothing. Memoized, so the result must not be modified.
+    """
+    actions = np.array(actions)
+    after_move = np.arange(max_cars)[np.newaxis, :] + direction * actions[:, np.newaxis]
+    if poisson_cutoff is None:
+        # Requests at or above the most cars there can be after moving all sell
+        # every car, so lumping the tail into the last entry is exact
+        requests_pmf = poisson_pmf(expected_requests, max_cars + int(np.max(np.abs(actions))), True)
+    else:
+        requests_pmf = poisson_pmf(expected_requests, poisson_cutoff, False)
+
+    requests = np.arange(len(requests_pmf))
+    sold = np.minimum(after_move[:, :, np.newaxis], requests)
+    revenue = sale_price * np.dot(sold, requests_pmf)
+    revenue[after_move < 0] = 0.0
+
+    ret = np.zeros((len(actions), max_cars, max_cars))
+    ret[actions] = revenue[:, :, np.newaxis]
+    ret.setflags(write=False)
+    return ret
+
 
 class JacksCarRental:
 
@@ -17,79 +104,124 @@ class JacksCarRental:
     # It will be very close to 0
     POISSON_CUTOFF = 14
 
-    def __init__(self, max_cars=21):
+    def __init__(self, max_cars=21, poisson_cutoff=POISSON_CUTOFF):
         """
         :param max_cars: Non-inclusive upper-bound for how many cars can be at a dealership
+        :param poisson_cutoff: Requests and returns at or above this are ignored.
+                               If None, no probability mass is dropped.
         """
         self.max_cars = max_cars
+        self.poisson_cutoff = poisson_cutoff
         self.action_space = np.arange(-5, 6)
         self.a_transitions = self.init_transition_probabilities('A')
         self.b_transitions = self.init_transition_probabilities('B')
         self.a_expected_revenue = self.init_expected_revenue('A')
         self.b_expected_revenue = self.init_expected_revenue('B')
+        self.init_action_tables()
+
+    def init_action_tables(self):
+        """
+        Precomputes, for every action and state, the number of cars at each
+        dealership after moving, whether that is a legal state, and the
+        expected immediate reward. Each is a len(self.action_space) x
+        self.max_cars x self.max_cars array.
+
+        Together with a_transitions and b_transitions this is a factored form
+        of the full (action, a, b, a', b') model: the dealerships are
+        independent given the cars left after moving.
+        """
+        cars = np.arange(self.max_cars)
+        actions = self.action_space[:, np.newaxis, np.newaxis]
+        moved_a = cars[np.newaxis, :, np.newaxis] - actions
+        moved_b = cars[np.newaxis, np.newaxis, :] + actions
+        self.valid_moves = (
+            (moved_a >= 0) & (moved_a < self.max_cars) &
+            (moved_b >= 0) & (moved_b < self.max_cars)
+        )
+        # An action is not allowed if it makes one dealership have less than 0 cars
+        self.allowed_actions = (moved_a >= 0) & (moved_b >= 0)
+        self.moved_a = np.clip(moved_a, 0, self.max_cars - 1)
+        self.moved_b = np.clip(moved_b, 0, self.max_cars - 1)
+
+        # The transition rows don't sum to exactly 1 if requests and returns
+        # are cut off at poisson_cutoff, so weight rewards the same way
+        mass = (self.a_transitions.sum(axis=1)[self.moved_a] *
+                self.b_transitions.sum(axis=1)[self.moved_b])
+        # Expected revenue only depends on the cars left after moving
+        revenue_a = self.a_expected_revenue[actions, cars[np.newaxis, :, np.newaxis], 0]
+        revenue_b = self.b_expected_revenue[actions, cars[np.newaxis, np.newaxis, :], 0]
+        cost = np.array([
+            [[self.get_action_cost((a, b), action) for b in cars] for a in cars]
+            for action in self.action_space
+        ])
+        self.expected_rewards = np.where(self.valid_moves, (revenue_a + revenue_b - cost) * mass, 0.0)
 
     def init_expected_revenue(self, dealership):
         """
-        Returns a self.max_cars x self.max_cars x len(self.action_space) array.
+        Returns a len(self.action_space) x self.max_cars x self.max_cars array.
         Each cell holds the expected revenue for the specified dealership with
-        the specified previous state, next state, and action.
+        the specified action, previous state, and next state.
         :param dealership: 'A' or 'B'
         """
-        revenue = np.zeros((self.action_space.shape[0], self.max_cars, self.max_cars))
-        for cars in range(self.max_cars):
-            for cars_after in range(self.max_cars):
-                for action in self.action_space:
-                    if (dealership is 'A' and cars - action < 0) or (dealership is 'B' and cars + action < 0):
-                        continue
-                    revenue[action, cars, cars_after] = self.get_expected_revenue(dealership, action, cars, cars_after)
-        return revenue
+        return dealership_expected_revenue(
+            self.max_cars,
+            self._expected_requests(dealership),
+            self.poisson_cutoff,
+            self._move_direction(dealership),
+            tuple(self.action_space),
+            self.RENTAL_SALE_PRICE
+        )
 
     def get_expected_revenue(self, dealership, action, now, after):
-        if dealership is 'A':
-            after_move = now - action
-        elif dealership is 'B':
-            after_move = now + action
+        after_move = now + self._move_direction(dealership) * action
+        pmf = self._requests_pmf(dealership, max(after_move, 0) + 1)
+        return self.RENTAL_SALE_PRICE * np.dot(pmf, np.minimum(after_move, np.arange(len(pmf))))
+
+    def init_transition_probabilities(self, dealership):
+        return dealership_transitions(
+            self.max_cars,
+            self._expected_requests(dealership),
+            self._expected_returns(dealership),
+            self.poisson_cutoff
+        )
+
+    def _move_direction(self, dealership):
+        """
+        Actions move cars from A to B.
+        """
+        if dealership == 'A':
+            return -1
+        elif dealership == 'B':
+            return 1
         else:
             raise ValueError('Dealership must be A or B')
 
-        expected_revenue = 0.0
-        for requests in range(self.POISSON_CUTOFF):
-            probability = self.expected_requests_probability(dealership, requests)
-            expected_revenue += probability * self.RENTAL_SALE_PRICE * min(after_move, requests)
+    def _expected_requests(self, dealership):
+        if dealership == 'A':
+            return self.EXPECTED_REQUESTS_A
+        elif dealership == 'B':
+            return self.EXPECTED_REQUESTS_B
+        else:
+            raise ValueError('Dealership must be A or B')
 
-        return expected_revenue
+    def _expected_returns(self, dealership):
+        if dealership == 'A':
+            return self.EXPECTED_RETURNS_A
+        elif dealership == 'B':
+            return self.EXPECTED_RETURNS_B
+        else:
+            raise ValueError('Dealership must be A or B')
 
-    def init_transition_probabilities(self, dealership):
-        ret = np.zeros((self.max_cars, self.max_cars))
-        for current in range(ret.shape[0]):
-            for next in range(ret.shape[1]):
-                probability = 0.0
-                for requests in range(self.POISSON_CUTOFF):
-                    for returns in range(self.POISSON_CUTOFF):
-                        cars_after_requests = max(current - requests, 0)
-                        cars_after_returns = min(cars_after_requests + returns, self.max_cars - 1)
-                        if cars_after_returns == next:
-                            request_probability = self.expected_requests_probability(dealership, requests)
-                            return_probability = self.expected_returns_probability(dealership, returns)
-                            probability += request_probability * return_probability
-                ret[current, next] = probability
-        return ret
+    def _requests_pmf(self, dealership, exact_size):
+        if self.poisson_cutoff is None:
+            return poisson_pmf(self._expected_requests(dealership), exact_size, True)
+        return poisson_pmf(self._expected_requests(dealership), self.poisson_cutoff, False)
 
     def expected_returns_probability(self, dealership, returns):
-        if dealership is 'A':
-            return self.poisson(self.EXPECTED_RETURNS_A, returns)
-        elif dealership is 'B':
-            return self.poisson(self.EXPECTED_RETURNS_B, returns)
-        else:
-            raise ValueError('Dealership must be A or B')
+        return self.poisson(self._expected_returns(dealership), returns)
 
     def expected_requests_probability(self, dealership, requests):
-        if dealership is 'A':
-            return self.poisson(self.EXPECTED_REQUESTS_A, requests)
-        elif dealership is 'B':
-            return self.poisson(self.EXPECTED_REQUESTS_B, requests)
-        else:
-            raise ValueError('Dealership must be A or B')
+        return self.poisson(self._expected_requests(dealership), requests)
 
     def poisson(self, expected, num):
         ret = ((expected**num)/math.factorial(num))*math.exp(-expected)
@@ -127,6 +259,39 @@ class JacksCarRental:
                 next_state_gain_expectation += probability_next_state * (immediate_reward + gamma * state_value[a_prime, b_prime])
         return next_state_gain_expectation
 
+    def action_values(self, state_value, gamma):
+        """
+        Returns the expected return of every action in every state, as a
+        len(self.action_space) x self.max_cars x self.max_cars array.
+        Actions that would leave a dealership with too few or too many cars
+        are worth 0, as in expected_return.
+        """
+        next_state_value = np.matmul(np.matmul(self.a_transitions, state_value), self.b_transitions.T)
+        future = np.where(self.valid_moves, next_state_value[self.moved_a, self.moved_b], 0.0)
+        return self.expected_rewards + gamma * future
+
+    def to_mdp(self, gamma=0.9):
+        """
+        Returns the problem as a TabularMDP. State a * max_cars + b has a
+        cars at A and b at B, and action i moves self.action_space[i] cars
+        from A to B. Moves that would leave a dealership with too many cars
+        lead nowhere and earn nothing, as in action_values.
+        """
+        num_states = self.max_cars**2
+        transitions = []
+        for action in range(len(self.action_space)):
+            # p(a'|a after moving) * p(b'|b after moving), indexed [a, b, a', b']
+            probabilities = (self.a_transitions[self.moved_a[action]][:, :, :, np.newaxis] *
+                             self.b_transitions[self.moved_b[action]][:, :, np.newaxis, :])
+            probabilities[~self.valid_moves[action]] = 0.0
+            transitions.append(probabilities.reshape(num_states, num_states))
+        return TabularMDP(
+            transitions,
+            self.expected_rewards.reshape(len(self.action_space), num_states).T,
+            gamma=gamma,
+            allowed=self.allowed_actions.reshape(len(self.action_space), num_states).T
+        )
+
     def evaluate_policy(self, policy, gamma=0.9, convergence=1.0):
         """
         Generates a value function for a given deterministic policy.
@@ -138,13 +303,12 @@ class JacksCarRental:
         :return: A self.max_cars x self.max_cars  array
         """
         ret = np.zeros((self.max_cars, self.max_cars))
+        action_indices = (np.asarray(policy, dtype=int) - self.action_space[0])[np.newaxis]
         diff = np.inf
         print(f'Evaluating policy until diff < {convergence}')
         while diff > convergence:
-            temp = np.copy(ret)
-            for a in range(policy.shape[0]):
-                for b in range(policy.shape[1]):
-                    ret[a, b] = self.expected_return((a, b), policy[a, b], temp, gamma)
+            temp = ret
+            ret = np.take_along_axis(self.action_values(temp, gamma), action_indices, axis=0)[0]
             diff = np.max(np.fabs(np.subtract(ret, temp)))
             print(f'Diff: {diff}')
         return ret
@@ -156,21 +320,10 @@ class JacksCarRental:
         :param value: A self.max_cars x self.max_cars array
         :return: A self.max_cars x self.max_cars array
         """
-        policy = np.zeros((self.max_cars, self.max_cars))
         print('Improving Policy...')
-        for a in tqdm(range(policy.shape[0])):
-            for b in range(policy.shape[1]):
-                best_action = [None, -np.inf]
-                for action in np.arange(-5, 6):
-                    if a - action < 0 or b + action < 0:
-                        # This action is not allowed if it makes one dealership have less than 0 cars
-                        continue
-                    next_state_gain_expectation = self.expected_return((a, b), action, value, gamma)
-                    if next_state_gain_expectation > best_action[1]:
-                        best_action[0] = action
-                        best_action[1] = next_state_gain_expectation
-                policy[a, b] = best_action[0]
-        return policy.astype(int)
+        values = np.where(self.allowed_actions, self.action_values(value, gamma), -np.inf)
+        # argmax picks the first best action, which is the lowest one like before
+        return self.action_space[np.argmax(values, axis=0)].astype(int)
 
     def run_policy_improvement(self, gamma=0.9, convergence=5.0):
         initial_policy = np.zeros((self.max_cars, self.max_cars), dtype=int)
@@ -0,0 +1,27 @@
+import argparse
+
+from environments.blackjack.blackjack import Blackjack, BlackjackStates, BlackjackPlotter
+from environments.blackjack.blackjack_model import BlackjackModel
+
+parser = argparse.ArgumentParser(description='Blackjack Value Iteration on the exact model')
+
+parser.add_argument('--verbose',
+                    type=bool,
+                    help='Print (a lot of) log messages',
+                    default=False)
+args = parser.parse_args()
+
+
+model = BlackjackModel()
+value, Q, optimal_policy = model.value_iteration()
+
+if args.verbose:
+    for state_id in range(optimal_policy.shape[0]):
+        print('--------------------------------')
+        BlackjackStates.print_state(state_id)
+        if (optimal_policy[state_id] == Blackjack.HIT_ACTION):
+            print('HIT')
+        else:
+            print('STAY')
+
+BlackjackPlotter.plot_policies(optimal_policy)
@@ -1,14 +1,22 @@
-import math
 import matplotlib.pyplot as plt
 import numpy as np
+import scipy.sparse
+
+from lib.mdp import TabularMDP
 
 
 class GamblersProblem():
 
     _plot_colors = ['b', 'g', 'r', 'c', 'm', 'y', 'k', 'w']
 
-    def __init__(self, win_probability=0.4):
+    # Roughly how many (state, stake) pairs to back up at once
+    BLOCK_SIZE = 2**22
+
+    def __init__(self, win_probability=0.4, goal=100):
         self._win_probability = win_probability
+        self.goal = goal
+        self._rewards = np.zeros(goal + 1)
+        self._rewards[goal] = 1.0
 
     def get_possible_next_states(self, state, action):
         ret = []
@@ -24,8 +32,8 @@ class GamblersProblem():
             if next_state == 0:
                 return 1.0
             return 0.0
-        if state == 100:
-            if next_state == 100:
+        if state == self.goal:
+            if next_state == self.goal:
                 return 1.0
             return 0.0
 
@@ -40,59 +48,103 @@ class GamblersProblem():
             return 0.0
 
     def reward(self, state, action, next_state):
-        if next_state == 100:
+        if next_state == self.goal:
             return 1.0
         else:
             return 0.0
 
-    def value_iteration(self, convergence=0.0001):
+    def _state_blocks(self):
+        """
+        Splits the non-terminal states into blocks of BLOCK_SIZE (state, stake) pairs.
+        """
+        states_per_block = max(1, self.BLOCK_SIZE // (self.goal // 2 + 1))
+        for start in range(1, self.goal, states_per_block):
+            yield np.arange(start, min(start + states_per_block, self.goal))
+
+    def _stake_gains(self, value, states):
+        """
+        Returns a len(states) x (largest stake + 1) array holding the expected
+        gain of every stake in every state, where states is a contiguous block.
+        Stakes above min(state, goal - state) are not allowed and get -inf.
+        """
+        target = self._rewards + value
+        largest_stake = min(states[-1], self.goal - states[0], self.goal // 2)
+        stakes = np.arange(largest_stake + 1)
+        allowed = stakes <= np.minimum(states, self.goal - states)[:, np.newaxis]
+        wins = np.minimum(states[:, np.newaxis] + stakes, self.goal)
+        losses = np.maximum(states[:, np.newaxis] - stakes, 0)
+        gains = self._win_probability * target[wins] + (1 - self._win_probability) * target[losses]
+        # A stake of 0 only has one next state, which probability_next_state
+        # treats as a loss
+        gains[:, 0] = (1 - self._win_probability) * target[states]
+        return np.where(allowed, gains, -np.inf)
+
+    def to_mdp(self):
+        """
+        Returns the problem as an undiscounted TabularMDP. States are the
+        capital from 0 to goal and action i stakes i. Both ends are
+        terminal, and a stake of 0 keeps the quirk of _stake_gains.
+        """
+        num_states = self.goal + 1
+        states = np.arange(1, self.goal)
+        transitions = []
+        for stake in range(self.goal // 2 + 1):
+            if stake == 0:
+                next_states = [states]
+                probabilities = [1 - self._win_probability]
+            else:
+                next_states = [np.minimum(states + stake, self.goal), np.maximum(states - stake, 0)]
+                probabilities = [self._win_probability, 1 - self._win_probability]
+            transitions.append(scipy.sparse.csr_matrix(
+                (np.repeat(probabilities, len(states)), (np.tile(states, len(next_states)), np.concatenate(next_states))),
+                shape=(num_states, num_states)
+            ))
+        mdp_states = np.arange(num_states)
+        allowed = np.arange(self.goal // 2 + 1) <= np.minimum(mdp_states, self.goal - mdp_states)[:, np.newaxis]
+        rewards = np.stack([t @ self._rewards for t in transitions], axis=1)
+        return TabularMDP(transitions, rewards, gamma=1.0, allowed=allowed)
+
+    def value_iteration(self, convergence=0.0001, max_history=None):
+        """
+        Returns the value function after each sweep.
+
+        :param max_history: If set, only the first max_history sweeps are kept,
+                            plus the final value function as the last entry.
+                            0 keeps only the final value function
+        """
+        if max_history is not None and max_history < 0:
+            raise ValueError(f'max_history must be at least 0, got {max_history}')
         diff = np.inf
-        value = np.zeros(101)
+        value = np.zeros(self.goal + 1)
         temp = np.copy(value)
         ret = []
         while diff > convergence:
-            for state in range(1, value.shape[0] - 1):
-                action_space = np.arange(0, min(state, 100 - state) + 1)
-                best_value = None
-                for action in action_space:
-                    possible_next_states = self.get_possible_next_states(state, action)
-                    gain = 0.0
-                    for next_state in possible_next_states:
-                        gain += self.probability_next_state(state, action, next_state) * (
-                            self.reward(state, action, next_state) + temp[next_state]
-                        )
-                    if best_value is None or gain > best_value:
-                        best_value = gain
-                value[state] = best_value
+            for states in self._state_blocks():
+                value[states] = np.max(self._stake_gains(temp, states), axis=1)
             diff = np.max(np.fabs(np.subtract(temp, value)))
             temp = np.copy(value)
+            if max_history is None or len(ret) < max_history:
+                ret.append(temp)
+        if not ret or ret[-1] is not temp:
             ret.append(temp)
         return ret
 
     def get_greedy_policy(self, value):
-        policy = np.zeros(101)
-        for state in np.arange(1, 100):
-            action_space = np.arange(0, min(state, 100 - state) + 1)
-            best_action = [None, -np.inf]
-            for action in action_space:
-                possible_next_states = self.get_possible_next_states(state, action)
-                gain = 0.0
-                for next_state in possible_next_states:
-                    gain += self.probability_next_state(state, action, next_state) * (
-                        self.reward(state, action, next_state) + value[next_state]
-                    )
-                if best_action[0] is None:
-                    best_action[0] = action
-                    best_action[1] = gain
-                elif math.isclose(gain, best_action[1]):
-                    # Tie breaking strategy
-                    # Choose more conservative action
-                    if action < best_action[0]:
-                        best_action[0] = action
-                elif gain > best_action[1]:
-                    best_action[0] = action
-                    best_action[1] = gain
-            policy[state] = best_action[0]
+        policy = np.zeros(self.goal + 1)
+        for states in self._state_blocks():
+            gains = self._stake_gains(value, states)
+            best_action = np.zeros(len(states), dtype=int)
+            best_gain = gains[:, 0].copy()
+            for action in range(1, gains.shape[1]):
+                gain = gains[:, action]
+                # Tie breaking strategy
+                # Choose more conservative action, so a stake only wins if
+                # it is better and not math.isclose to the best so far
+                close = np.fabs(gain - best_gain) <= 1e-09 * np.maximum(np.fabs(gain), np.fabs(best_gain))
+                better = (gain > best_gain) & ~close
+                best_action[better] = action
+                best_gain[better] = gain[better]
+            policy[states] = best_action
         return policy
 
     def plot_value_functions(self, value_functions):
@@ -104,7 +156,7 @@ class GamblersProblem():
         plt.legend(loc=4)
 
     def plot_policy(self, policy):
-        plt.plot(np.arange(0, 101), policy)
+        plt.plot(np.arange(0, self.goal + 1), policy)
         plt.title(f'Optimal Policy for Gambler (Win Probability = {self._win_probability})')
         plt.xlabel('Captial')
         plt.ylabel('Stake')
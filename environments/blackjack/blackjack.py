@@ -52,7 +52,7 @@ class BlackjackPlotter:
 
         plt.xlabel('Dealer showing')
         plt.xticks(np.arange(0, len(BlackjackStates.DEALER_CARDS), 1))
-        ax.set_xticklabels(BlackjackStates.DEALER_CARDS)
+        ax.set_xticklabels([BlackjackStates.card_name(card) for card in BlackjackStates.DEALER_CARDS])
 
         plt.ylabel('Agent sum')
         plt.yticks(np.arange(0, len(BlackjackStates.AGENT_SUMS), 1))
@@ -69,7 +69,9 @@ class BlackjackPlotter:
 
 class BlackjackStates:
 
-    DEALER_CARDS = ['A', 2, 3, 4, 5, 6, 7, 8, 9, 10]
+    # Cards are ints, with an ace as 1
+    ACE = 1
+    DEALER_CARDS = [ACE, 2, 3, 4, 5, 6, 7, 8, 9, 10]
     AGENT_SUMS = [12, 13, 14, 15, 16, 17, 18, 19, 20, 21]
     USABLE_ACE = [True, False]
     STATES = []
@@ -78,6 +80,15 @@ class BlackjackStates:
             for _usable_ace in USABLE_ACE:
                 STATES.append((dealer_card, agent_sum, _usable_ace))
 
+    # Lookup tables from state id to each part of the state
+    ID_TO_DEALER_CARD = np.array([state[0] for state in STATES])
+    ID_TO_AGENT_SUM = np.array([state[1] for state in STATES])
+    ID_TO_USABLE_ACE = np.array([state[2] for state in STATES])
+
+    # And back again, indexed by [dealer card, agent sum, usable ace]. Other entries are -1.
+    STATE_IDS = np.full((max(DEALER_CARDS) + 1, max(AGENT_SUMS) + 1, 2), -1, dtype=int)
+    STATE_IDS[ID_TO_DEALER_CARD, ID_TO_AGENT_SUM, ID_TO_USABLE_ACE.astype(int)] = np.arange(len(STATES))
+
     @staticmethod
     def state_space_shape():
         return (len(BlackjackStates.DEALER_CARDS),
@@ -96,20 +107,19 @@ class BlackjackStates:
 
     @staticmethod
     def state_to_id(state):
-        dealer_card_index = BlackjackStates.DEALER_CARDS.index(state[0])
-        agent_sum_index = BlackjackStates.AGENT_SUMS.index(state[1])
-        usable_ace_index = BlackjackStates.USABLE_ACE.index(state[2])
-        return (
-            dealer_card_index * len(BlackjackStates.AGENT_SUMS) * len(BlackjackStates.USABLE_ACE) +
-            agent_sum_index * len(BlackjackStates.USABLE_ACE) +
-            usable_ace_index
-        )
+        return int(BlackjackStates.STATE_IDS[state[0], state[1], int(state[2])])
+
+    @staticmethod
+    def card_name(card):
+        if card == BlackjackStates.ACE:
+            return 'A'
+        return str(card)
 
     @staticmethod
     def print_state(state):
         if type(state) is int:
             state = BlackjackStates.id_to_state(state)
-        dealer_card = state[0]
+        dealer_card = BlackjackStates.card_name(state[0])
         agent_sum = state[1]
         usable_ace = state[2]
         print(f'Dealer: {dealer_card}, Agent sum: {agent_sum}, Ace: {usable_ace}')
@@ -120,7 +130,8 @@ class Blackjack:
     GAME_OVER_STATE = -1
     HIT_ACTION = 0
     STAY_ACTION = 1
-    HIT_CARDS = ['A', 2, 3, 4, 5, 6, 7, 8, 9, 10, 10, 10, 10]
+    HIT_CARDS = [BlackjackStates.ACE, 2, 3, 4, 5, 6, 7, 8, 9, 10, 10, 10, 10]
+    _HIT_CARDS = np.array(HIT_CARDS)
 
     def __init__(self, verbose=True):
         self._states = []
@@ -137,7 +148,7 @@ class Blackjack:
         running_total = 0
         num_aces = 0
         for card in hand:
-            if card == 'A':
+            if card == BlackjackStates.ACE:
                 num_aces += 1
             else:
                 running_total += card
@@ -159,15 +170,14 @@ class Blackjack:
         Returns a card value in the range [1, 10] because a player can't draw
         another usable ace.
         """
-        card = self._draw_card()
-        if card == 'A':
-            return 1
-        else:
-            return card
+        return self._draw_card()
 
-    def debug_print(self, message):
+    def debug_print(self, message, *args):
+        """
+        Prints message.format(*args), only formatting it if verbose.
+        """
         if self._verbose:
-            print(message)
+            print(message.format(*args))
 
     def num_states(self):
         return BlackjackStates.num_states()
@@ -187,9 +197,9 @@ class Blackjack:
         player_sum = state[1]
         usable_ace = state[2]
         if action == self.HIT_ACTION:
-            self.debug_print(f'You hit!')
+            self.debug_print('You hit!')
             card = self._player_draw_card()
-            self.debug_print(f'You drew {card}')
+            self.debug_print('You drew {}', card)
             player_sum += card
             if player_sum > 21:
                 if usable_ace:
@@ -199,53 +209,143 @@ class Blackjack:
                     return (0, BlackjackStates.state_to_id(next_state), False)
                 else:
                     # Lose
-                    self.debug_print(f'You busted with {player_sum}.')
+                    self.debug_print('You busted with {}.', player_sum)
                     return (-1, self.GAME_OVER_STATE, True)
             else:
                 # Still <= 21
                 next_state = (dealer_card, player_sum, usable_ace)
                 return (0, BlackjackStates.state_to_id(next_state), False)
         elif action == self.STAY_ACTION:
-            self.debug_print(f'You stayed!')
+            self.debug_print('You stayed!')
             # Dealer's turn
             dealer_cards = [dealer_card]
             dealer_sum = self._blackjack_sum(dealer_cards)
 
             blackjack = False
             if player_sum == 21 and usable_ace:
-                self.debug_print(f'You have a blackjack!')
+                self.debug_print('You have a blackjack!')
                 blackjack = True
 
             # Dealer must hit until he has over 17
             while dealer_sum < 17:
                 card = self._draw_card()
-                self.debug_print(f'Dealer had {dealer_sum}, and drew {card}')
+                self.debug_print('Dealer had {}, and drew {}', dealer_sum, BlackjackStates.card_name(card))
                 dealer_cards.append(card)
                 dealer_sum = self._blackjack_sum(dealer_cards)
                 if dealer_sum != 21 and blackjack:
                     # If dealer doesn't have 21 after first draw,
                     # player immediately wins.
-                    self.debug_print(f'You win!')
+                    self.debug_print('You win!')
                     return (1, self.GAME_OVER_STATE, True)
 
             if dealer_sum > 21:
                 # Dealer busted
-                self.debug_print(f'Dealer busted.')
+                self.debug_print('Dealer busted.')
                 return (1, self.GAME_OVER_STATE, True)
             else:
                 if dealer_sum > player_sum:
                     # Lose
-                    self.debug_print(f'Dealer won with {dealer_sum}.')
+                    self.debug_print('Dealer won with {}.', dealer_sum)
                     return (-1, self.GAME_OVER_STATE, True)
                 elif dealer_sum == player_sum:
-                    self.debug_print(f'Draw. Dealer and player both have {player_sum}.')
+                    self.debug_print('Draw. Dealer and player both have {}.', player_sum)
                     return (0, self.GAME_OVER_STATE, True)
                 else:
                     # Win
-                    self.debug_print(f'You won! Dealer: {dealer_sum}. You: {player_sum}.')
+                    self.debug_print('You won! Dealer: {}. You: {}.', dealer_sum, player_sum)
                     return (1, self.GAME_OVER_STATE, True)
         else:
             raise ValueError('This is not a valid action.')
 
+    def perform_action_batch(self, state_ids, actions, rng=None):
+        """
+        Plays one action in each of many independent hands at once.
+        Nothing is printed, whatever verbose is.
+
+        Returns arrays of rewards, next states and if each hand is over.
+        """
+        if rng is None:
+            rng = np.random.default_rng()
+        state_ids = np.asarray(state_ids)
+        actions = np.asarray(actions)
+        dealer_cards = BlackjackStates.ID_TO_DEALER_CARD[state_ids]
+        player_sums = BlackjackStates.ID_TO_AGENT_SUM[state_ids]
+        usable_aces = BlackjackStates.ID_TO_USABLE_ACE[state_ids]
+
+        rewards = np.zeros(len(state_ids), dtype=int)
+        next_state_ids = np.full(len(state_ids), self.GAME_OVER_STATE, dtype=int)
+        done = np.ones(len(state_ids), dtype=bool)
+
+        if np.any((actions != self.HIT_ACTION) & (actions != self.STAY_ACTION)):
+            raise ValueError('This is not a valid action.')
+
+        # Hits
+        hits = np.flatnonzero(actions == self.HIT_ACTION)
+        new_sums = player_sums[hits] + self._HIT_CARDS[rng.integers(0, len(self.HIT_CARDS), size=len(hits))]
+        new_aces = usable_aces[hits]
+        over = new_sums > 21
+        # Ace becomes 1
+        saved = over & new_aces
+        new_sums[saved] -= 10
+        new_aces = new_aces & ~saved
+        busted = over & ~saved
+        rewards[hits[busted]] = -1
+        alive = hits[~busted]
+        next_state_ids[alive] = BlackjackStates.STATE_IDS[
+            dealer_cards[alive], new_sums[~busted], new_aces[~busted].astype(int)
+        ]
+        done[alive] = False
+
+        # Stays
+        stays = np.flatnonzero(actions == self.STAY_ACTION)
+        rewards[stays] = self._play_dealer_batch(
+            dealer_cards[stays], player_sums[stays], usable_aces[stays], rng
+        )
+
+        return rewards, next_state_ids, done
+
+    def _play_dealer_batch(self, dealer_cards, player_sums, usable_aces, rng):
+        """
+        Plays out the dealer's hand for many stays at once, following the
+        same rules as perform_action, and returns the player's rewards.
+        """
+        rewards = np.zeros(len(dealer_cards), dtype=int)
+        hard_totals = dealer_cards.copy()
+        has_ace = dealer_cards == BlackjackStates.ACE
+        blackjacks = (player_sums == 21) & usable_aces
+
+        # The dealer is always below 17 showing one card
+        playing = np.arange(len(dealer_cards))
+        first_draw = True
+        while len(playing) > 0:
+            cards = self._HIT_CARDS[rng.integers(0, len(self.HIT_CARDS), size=len(playing))]
+            hard_totals[playing] += cards
+            has_ace[playing] |= cards == BlackjackStates.ACE
+            if first_draw:
+                # If dealer doesn't have 21 after first draw,
+                # a player with a blackjack immediately wins.
+                sums = self._blackjack_sums(hard_totals[playing], has_ace[playing])
+                won = blackjacks[playing] & (sums != 21)
+                rewards[playing[won]] = 1
+                playing = playing[~won]
+                first_draw = False
+            sums = self._blackjack_sums(hard_totals[playing], has_ace[playing])
+            playing = playing[sums < 17]
+
+        finished = ~(blackjacks & (rewards == 1))
+        dealer_sums = self._blackjack_sums(hard_totals, has_ace)
+        player_wins = (dealer_sums > 21) | (dealer_sums < player_sums)
+        rewards[finished & player_wins] = 1
+        rewards[finished & ~player_wins & (dealer_sums > player_sums)] = -1
+        return rewards
+
+    @staticmethod
+    def _blackjack_sums(hard_totals, has_ace):
+        """
+        Vectorized _blackjack_sum, for hands given as their total with aces
+        as 1 and whether they hold an ace.
+        """
+        return np.where(has_ace & (hard_totals + 10 <= 21), hard_totals + 10, hard_totals)
+
     def is_terminal(self, state):
         return state == self.GAME_OVER_STATE
@@ -0,0 +1,160 @@
+from functools import lru_cache
+
+import numpy as np
+
+from environments.blackjack.blackjack import Blackjack, BlackjackStates
+from lib.mdp import TabularMDP
+
+
+# Final dealer totals, in the order used by dealer_outcome_distribution
+DEALER_TOTALS = [17, 18, 19, 20, 21]
+DEALER_BUST = len(DEALER_TOTALS)
+
+
+def _card_probabilities():
+    """
+    Returns a dict of card value to the probability of drawing it from
+    Blackjack.HIT_CARDS.
+    """
+    probabilities = {}
+    for card in Blackjack.HIT_CARDS:
+        probabilities[card] = probabilities.get(card, 0.0) + 1.0 / len(Blackjack.HIT_CARDS)
+    return probabilities
+
+
+def _dealer_sum(hard_total, has_ace):
+    """
+    Same as Blackjack._blackjack_sum, for a hand summarised by its total
+    and whether it holds an ace.
+    """
+    if has_ace and hard_total + 10 <= 21:
+        return hard_total + 10
+    return hard_total
+
+
+@lru_cache(maxsize=None)
+def _dealer_outcomes_from(hard_total, has_ace):
+    dealer_sum = _dealer_sum(hard_total, has_ace)
+    outcomes = np.zeros(len(DEALER_TOTALS) + 1)
+    if dealer_sum > 21:
+        outcomes[DEALER_BUST] = 1.0
+    elif dealer_sum >= 17:
+        outcomes[DEALER_TOTALS.index(dealer_sum)] = 1.0
+    else:
+        for value, probability in _card_probabilities().items():
+            outcomes += probability * _dealer_outcomes_from(hard_total + value, has_ace or value == BlackjackStates.ACE)
+    outcomes.setflags(write=False)
+    return outcomes
+
+
+def dealer_outcome_distribution(dealer_card):
+    """
+    Returns the exact probability of the dealer finishing on each of
+    DEALER_TOTALS, followed by the probability of busting, when showing
+    dealer_card. The dealer hits below 17, as in Blackjack.perform_action.
+    """
+    return _dealer_outcomes_from(dealer_card, dealer_card == BlackjackStates.ACE)
+
+
+def dealer_first_draw_21_probability(dealer_card):
+    """
+    Returns the probability that the dealer's first draw makes 21, which
+    is the only way the dealer can tie a player's blackjack.
+    """
+    probability = 0.0
+    for card, card_probability in _card_probabilities().items():
+        has_ace = dealer_card == BlackjackStates.ACE or card == BlackjackStates.ACE
+        if _dealer_sum(dealer_card + card, has_ace) == 21:
+            probability += card_probability
+    return probability
+
+
+class BlackjackModel:
+    """
+    The exact transition and reward model of Blackjack over BlackjackStates.
+
+    transitions[a, s, s'] is the probability of moving from s to the
+    non-terminal state s' after action a; whatever probability is missing
+    from a row is the chance the hand ends. rewards[s, a] is the expected
+    immediate reward.
+    """
+
+    def __init__(self):
+        num_states = BlackjackStates.num_states()
+        self.transitions = np.zeros((2, num_states, num_states))
+        self.rewards = np.zeros((num_states, 2))
+        for state_id in range(num_states):
+            self._init_hit(state_id)
+            self._init_stay(state_id)
+
+    def _init_hit(self, state_id):
+        (dealer_card, player_sum, usable_ace) = BlackjackStates.id_to_state(state_id)
+        for value, probability in _card_probabilities().items():
+            new_sum = player_sum + value
+            if new_sum > 21:
+                if usable_ace:
+                    # Ace becomes 1
+                    next_state = (dealer_card, new_sum - 10, False)
+                    self.transitions[Blackjack.HIT_ACTION, state_id, BlackjackStates.state_to_id(next_state)] += probability
+                else:
+                    self.rewards[state_id, Blackjack.HIT_ACTION] -= probability
+            else:
+                next_state = (dealer_card, new_sum, usable_ace)
+                self.transitions[Blackjack.HIT_ACTION, state_id, BlackjackStates.state_to_id(next_state)] += probability
+
+    def _init_stay(self, state_id):
+        (dealer_card, player_sum, usable_ace) = BlackjackStates.id_to_state(state_id)
+        if player_sum == 21 and usable_ace:
+            # A blackjack wins unless the dealer's first draw makes 21, which is a draw
+            self.rewards[state_id, Blackjack.STAY_ACTION] = 1.0 - dealer_first_draw_21_probability(dealer_card)
+            return
+
+        outcomes = dealer_outcome_distribution(dealer_card)
+        totals = np.array(DEALER_TOTALS)
+        win = outcomes[DEALER_BUST] + np.sum(outcomes[:DEALER_BUST][totals < player_sum])
+        lose = np.sum(outcomes[:DEALER_BUST][totals > player_sum])
+        self.rewards[state_id, Blackjack.STAY_ACTION] = win - lose
+
+    def action_values(self, value):
+        """
+        Returns the num_states x 2 array of R(s, a) + sum_s' p(s'|s, a) V(s').
+        """
+        return self.rewards + np.einsum('ast,t->sa', self.transitions, value)
+
+    def to_mdp(self):
+        """
+        Returns the model as an undiscounted TabularMDP.
+        """
+        return TabularMDP(self.transitions, self.rewards, gamma=1.0)
+
+    def value_iteration(self, convergence=1e-12):
+        """
+        Returns the optimal state values, action values and deterministic policy.
+
+        Every hit raises the player's sum or uses up their ace, so hands
+        can't cycle and this converges exactly in a handful of sweeps.
+        """
+        value = np.zeros(BlackjackStates.num_states())
+        diff = np.inf
+        while diff > convergence:
+            Q = self.action_values(value)
+            new_value = np.max(Q, axis=1)
+            diff = np.max(np.fabs(new_value - value))
+            value = new_value
+        Q = self.action_values(value)
+        return value, Q, np.argmax(Q, axis=1)
+
+    def evaluate_policy(self, policy, convergence=1e-12):
+        """
+        Returns the exact state values and action values of a deterministic
+        policy, for checking how far Monte Carlo estimates are from the truth.
+        """
+        policy = np.asarray(policy, dtype=int)
+        states = np.arange(BlackjackStates.num_states())
+        value = np.zeros(BlackjackStates.num_states())
+        diff = np.inf
+        while diff > convergence:
+            new_value = self.action_values(value)[states, policy]
+            diff = np.max(np.fabs(new_value - value))
+            value = new_value
+        return value, self.action_values(value)
@@ -10,7 +10,7 @@ while not blackjack.is_terminal(state):
         ace_string = 'with ace'
     else:
         ace_string = 'no ace'
-    print(f'--- Dealer showing: {dealer_card} --- You: {player_sum} ({ace_string}) ---')
+    print(f'--- Dealer showing: {BlackjackStates.card_name(dealer_card)} --- You: {player_sum} ({ace_string}) ---')
 
     action = None
     while action is None:
@@ -0,0 +1,150 @@
+"""
+Compact racetrack policy files
+
+A policy file is an uncompressed .npz holding a small header followed by
+the policy itself, stored as one of
+    deterministic: a uint8 action per state
+    alias: a per-state alias table, a float32 probability and a uint8 alias
+           per (state, action), for O(1) sampling of soft policies
+    float16: the num_states x num_actions probabilities quantized to float16
+
+The header records the format version, the sha1 of the track csv, the
+state layout and its shape, whether states are indexed compactly (see
+RaceTrack) and the kind of policy. Files are memory-mapped on load, so
+even huge tracks start instantly.
+"""
+import zipfile
+
+import numpy as np
+
+from lib.npz import load_npz, save_npz
+from lib.sampling import AliasTable, sample
+
+FORMAT_VERSION = 1
+STATE_LAYOUT = ('col', 'row', 'horizontal_speed', 'vertical_speed')
+
+
+def _uniform(rng):
+    if rng is None:
+        return np.random.random()
+    return rng.random()
+
+
+class DeterministicPolicy:
+
+    def __init__(self, actions):
+        self.actions = actions
+
+    def sample_action(self, state_id, rng=None):
+        return int(self.actions[state_id])
+
+
+class AliasPolicy:
+
+    def __init__(self, probability, alias):
+        self.probability = probability
+        self.alias = alias
+
+    def sample_action(self, state_id, rng=None):
+        num_actions = self.probability.shape[1]
+        r = _uniform(rng) * num_actions
+        column = min(int(r), num_actions - 1)
+        if r - column >= self.probability[state_id, column]:
+            return int(self.alias[state_id, column])
+        return column
+
+
+class DensePolicy:
+    """
+    A num_states x num_actions array of probabilities, such as a float16
+    policy file or a plain policy saved with np.save. Rows don't need to be
+    normalised.
+    """
+
+    def __init__(self, probabilities):
+        self.probabilities = probabilities
+
+    def sample_action(self, state_id, rng=None):
+        return sample(np.asarray(self.probabilities[state_id], dtype=float), rng)
+
+
+def _state_shape(racetrack):
+    (cols, rows) = racetrack.dimensions
+    return np.array([cols, rows, racetrack.MAX_SPEED, racetrack.MAX_SPEED])
+
+
+def save_policy(path, policy, racetrack, soft_format='alias'):
+    """
+    Saves a num_states x num_actions policy for racetrack to path.
+
+    Policies that put all their probability on one action per state are
+    stored as a uint8 action per state. Anything else is stored as
+    soft_format, either 'alias' or 'float16'.
+    """
+    policy = np.asarray(policy, dtype=float)
+    if policy.shape != (racetrack.num_states(), racetrack.num_actions()):
+        raise ValueError(f'Policy has shape {policy.shape}, expected '
+                         f'{(racetrack.num_states(), racetrack.num_actions())}')
+
+    arrays = {}
+    if np.all(np.count_nonzero(policy, axis=1) == 1):
+        kind = 'deterministic'
+        arrays['actions'] = np.argmax(policy, axis=1).astype(np.uint8)
+    elif soft_format == 'alias':
+        kind = 'alias'
+        arrays['probability'] = np.empty(policy.shape, dtype=np.float32)
+        arrays['alias'] = np.empty(policy.shape, dtype=np.uint8)
+        for state_id, row in enumerate(policy):
+            table = AliasTable(row if row.sum() > 0 else np.ones(len(row)))
+            arrays['probability'][state_id] = table.probability
+            arrays['alias'][state_id] = table.alias
+    elif soft_format == 'float16':
+        kind = 'float16'
+        arrays['probabilities'] = policy.astype(np.float16)
+    else:
+        raise ValueError(f'Unknown soft policy format {soft_format}')
+
+    save_npz(
+        path,
+        compress=False,
+        format_version=np.array(FORMAT_VERSION),
+        track_hash=np.array(racetrack.track_hash),
+        state_layout=np.array(STATE_LAYOUT),
+        state_shape=_state_shape(racetrack),
+        compact=np.array(racetrack.compact),
+        kind=np.array(kind),
+        **arrays
+    )
+
+
+def load_policy(path, racetrack=None, mmap_mode='r'):
+    """
+    Loads a policy saved with save_policy, or a plain policy array saved
+    with np.save, and returns an object whose sample_action(state_id)
+    samples an action from it.
+
+    If racetrack is given, a policy file built for a different track raises
+    a ValueError.
+    """
+    # Policy files are zip archives whatever they're named
+    if not zipfile.is_zipfile(path):
+        return DensePolicy(np.load(path, mmap_mode=mmap_mode))
+
+    arrays = load_npz(path, mmap_mode)
+    if int(arrays['format_version']) != FORMAT_VERSION:
+        raise ValueError(f'{path} is policy format version {int(arrays["format_version"])}, '
+                         f'expected {FORMAT_VERSION}')
+    if racetrack is not None:
+        if str(arrays['track_hash']) != racetrack.track_hash:
+            raise ValueError(f'{path} was saved for a different racetrack')
+        if tuple(arrays['state_layout']) != STATE_LAYOUT or \
+                not np.array_equal(arrays['state_shape'], _state_shape(racetrack)) or \
+                bool(arrays['compact']) != racetrack.compact:
+            raise ValueError(f'{path} has a different state layout to the racetrack')
+
+    kind = str(arrays['kind'])
+    if kind == 'deterministic':
+        return DeterministicPolicy(arrays['actions'])
+    if kind == 'alias':
+        return AliasPolicy(arrays['probability'], arrays['alias'])
+    return DensePolicy(arrays['probabilities'])
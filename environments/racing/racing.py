@@ -1,23 +1,29 @@
-import csv
+import hashlib
 import os
 import random
 import sys
+import tempfile
 import time
 
 import numpy as np
 import pygame
 
+from environments.racing.policy_file import DensePolicy, load_policy
+
 
 class RacerBot:
 
     def __init__(self, policy):
+        """
+        :param policy: A policy from policy_file.load_policy, or a
+                       num_states x num_actions array
+        """
+        if isinstance(policy, np.ndarray):
+            policy = DensePolicy(policy)
         self.policy = policy
 
     def get_action(self, state_id):
-        choices = np.arange(0, self.policy.shape[1])
-        probabilities = self.policy[state_id]
-        probabilities /= probabilities.sum()
-        return np.random.choice(choices, p=probabilities)
+        return self.policy.sample_action(state_id)
 
 
 class RaceTrack:
@@ -30,41 +36,69 @@ class RaceTrack:
 
     MAX_SPEED = 5
 
-    def __init__(self, csv_path):
-        self.track = []
-        self.start_locations = []
-        self.finish_locations = []
-        with open(csv_path, 'r') as csvfile:
-            track_layout = csv.reader(csvfile, delimiter=',')
-            row_num = 0
-            for row in track_layout:
-                new_row = []
-                col_num = 0
-                for cell in row:
-                    new_cell = int(cell)
-                    if new_cell == RaceTrack.START:
-                        self.start_locations.append([col_num, row_num])
-                    if new_cell == RaceTrack.FINISH:
-                        self.finish_locations.append([col_num, row_num])
-                    new_row.append(new_cell)
-                    col_num += 1
-                self.track.append(new_row)
-                row_num += 1
-
-        self.states = []
-        for col in range(len(self.track[0])):
-            for row in range(len(self.track)):
-                for horizontal_speed in np.arange(0, self.MAX_SPEED):
-                    for vertical_speed in np.arange(0, self.MAX_SPEED):
-                        self.states.append((col, row, horizontal_speed, vertical_speed))
+    # Marks a compiled transition that sends the car back to a random
+    # starting line cell
+    RESET_STATE = -1
+
+    # Bump this when the transition rules change so stale caches are rebuilt
+    COMPILED_VERSION = 1
+
+    def __init__(self, csv_path, compiled=False, cache_dir=None, compact=False, swept_collisions=False):
+        """
+        :param compiled: Precompute the next state, reward and done flag of every
+                         (state, action) pair so that perform_action is one lookup
+        :param cache_dir: Where compiled tables are cached. Defaults to a .compiled
+                          directory next to the track csv
+        :param compact: Only give ids to states on track and starting line cells,
+                        the only cells a car can be in, instead of every cell
+        :param swept_collisions: Crash if any cell the car passes through before
+                                 the finish line is off the track, rather than
+                                 only checking the cell it ends up in
+        """
+        with open(csv_path, 'rb') as csvfile:
+            # Identifies the layout, so compiled tables and policy files can be
+            # matched to the track they were built for
+            self.track_hash = hashlib.sha1(csvfile.read()).hexdigest()
+
+        # Indexed as track[row, col]
+        self.track = np.loadtxt(csv_path, delimiter=',', dtype=np.uint8, ndmin=2)
+        # [col, row] pairs, in the order they appear in the csv
+        self.start_locations = np.argwhere(self.track == RaceTrack.START)[:, ::-1].tolist()
+        self.finish_locations = np.argwhere(self.track == RaceTrack.FINISH)[:, ::-1].tolist()
+
+        # Cells are numbered column by column, and each cell has
+        # MAX_SPEED * MAX_SPEED consecutive state ids, one per speed
+        self.compact = compact
+        (num_rows, num_cols) = self.track.shape
+        if compact:
+            indexed = (self.track == RaceTrack.TRACK) | (self.track == RaceTrack.START)
+        else:
+            indexed = np.ones(self.track.shape, dtype=bool)
+        (self._cell_cols, self._cell_rows) = np.nonzero(indexed.T)
+        self._cell_ids = np.full((num_cols, num_rows), -1, dtype=np.int32)
+        self._cell_ids[self._cell_cols, self._cell_rows] = np.arange(len(self._cell_cols))
+
+        self.swept_collisions = swept_collisions
+        self._init_path_tables()
 
         self.actions = []
         for horizontal_accel in np.arange(-1, 2):
             for vertical_accel in np.arange(-1, 2):
                 self.actions.append((horizontal_accel, vertical_accel))
 
+        self.start_state_ids = np.array(
+            [self.state_to_id((col, row, 0, 0)) for (col, row) in self.start_locations],
+            dtype=np.int32
+        )
+
+        self.compiled = compiled
+        if compiled:
+            if cache_dir is None:
+                cache_dir = os.path.join(os.path.dirname(os.path.abspath(csv_path)), '.compiled')
+            self._load_or_compile(cache_dir)
+
     def num_states(self):
-        return len(self.states)
+        return len(self._cell_cols) * self.MAX_SPEED * self.MAX_SPEED
 
     def num_actions(self):
         return len(self.actions)
@@ -79,66 +113,219 @@ class RaceTrack:
         return self.actions[id]
 
     def state_to_id(self, state):
+        """
+        Works on a single state or on a tuple of arrays of columns, rows
+        and speeds.
+        """
         col = state[0]
         row = state[1]
         horizontal_speed = state[2]
         vertical_speed = state[3]
         return (
-            col * len(self.track) * self.MAX_SPEED * self.MAX_SPEED +
-            row * self.MAX_SPEED * self.MAX_SPEED +
+            self._cell_ids[col, row] * self.MAX_SPEED * self.MAX_SPEED +
             horizontal_speed * self.MAX_SPEED +
             vertical_speed
         )
 
     def id_to_state(self, id):
-        return self.states[id]
+        """
+        Works on a single state id or an array of them.
+        """
+        (cell, speed) = divmod(id, self.MAX_SPEED * self.MAX_SPEED)
+        (horizontal_speed, vertical_speed) = divmod(speed, self.MAX_SPEED)
+        return (self._cell_cols[cell], self._cell_rows[cell], horizontal_speed, vertical_speed)
 
     def perform_action(self, state_id, action_id):
         """
         Returns reward, next state, and if we finished.
         """
+        if self.compiled:
+            reward = int(self.rewards[state_id, action_id])
+            next_state_id = int(self.next_state_ids[state_id, action_id])
+            if next_state_id == self.RESET_STATE:
+                next_state_id = self.get_starting_state()
+            return (reward, next_state_id, bool(self.done[state_id, action_id]))
+
+        (reward, next_state_id, done) = self._transition(state_id, action_id)
+        if next_state_id == self.RESET_STATE:
+            next_state_id = self.get_starting_state()
+        return (reward, next_state_id, done)
+
+    def _transition(self, state_id, action_id):
+        """
+        The deterministic part of perform_action. Returns RESET_STATE as the
+        next state when the car goes back to the starting line.
+        """
         state = self.id_to_state(state_id)
-        current_location = [state[0], state[1]]
-        current_speed = [state[2], state[3]]
         action = self.id_to_action(action_id)
 
-        current_speed[0] = max(min(current_speed[0] + action[0], self.MAX_SPEED - 1), 0)
-        current_speed[1] = max(min(current_speed[1] + action[1], self.MAX_SPEED - 1), 0)
-        if current_speed[0] == 0 and current_speed[1] == 0:
-            current_speed[1] = 1
-        if self.crosses_finish_line(current_location, current_speed):
-            next_state = self.starting_line_state()
-            return (0, self.state_to_id(next_state), True)
-        else:
-            next_location = self.get_next_location(current_location, current_speed)
-            if self.out_of_bounds(next_location):
-                next_state = self.starting_line_state()
-                return (-5, self.state_to_id(next_state), False)
-            next_state = (next_location[0], next_location[1], current_speed[0], current_speed[1])
-            return (-1, self.state_to_id(next_state), False)
+        horizontal_speed = max(min(state[2] + action[0], self.MAX_SPEED - 1), 0)
+        vertical_speed = max(min(state[3] + action[1], self.MAX_SPEED - 1), 0)
+        if horizontal_speed == 0 and vertical_speed == 0:
+            vertical_speed = 1
+        path = (state[0], state[1], horizontal_speed, vertical_speed)
+        if self._finishes[path]:
+            return (0, self.RESET_STATE, True)
+        if self._crashes[path]:
+            return (-5, self.RESET_STATE, False)
+        next_state_id = (
+            self._next_cell_ids[path] * self.MAX_SPEED * self.MAX_SPEED +
+            horizontal_speed * self.MAX_SPEED +
+            vertical_speed
+        )
+        return (-1, int(next_state_id), False)
 
-    def crosses_finish_line(self, position, speed):
-        horizontal = speed[0]
-        vertical = speed[1]
-        intermediate_location = [0, 0]
-        intermediate_location[0] = position[0]
-        intermediate_location[1] = position[1]
-        while (horizontal + vertical > 0):
-            if horizontal >= vertical:
-                intermediate_location[0] += 1
-                horizontal -= 1
+    def step_batch(self, state_ids, action_ids, rng=None):
+        """
+        Advances many independent cars at once. Cars that finish or crash
+        are put back on a random starting line cell.
+
+        Returns arrays of rewards, next states, and if each car finished.
+        """
+        if not self.compiled:
+            self.compile()
+            self.compiled = True
+        rewards = self.rewards[state_ids, action_ids]
+        next_state_ids = self.next_state_ids[state_ids, action_ids]
+        done = self.done[state_ids, action_ids]
+        reset = next_state_ids == self.RESET_STATE
+        num_reset = np.count_nonzero(reset)
+        if num_reset > 0:
+            next_state_ids[reset] = self.get_starting_states(num_reset, rng)
+        return rewards, next_state_ids, done
+
+    def compile(self):
+        """
+        Builds num_states x num_actions tables of next state ids, rewards
+        and done flags, using the same rules as _transition for every
+        (state, action) pair at once.
+        """
+        (cols, rows, horizontal_speeds, vertical_speeds) = self.id_to_state(np.arange(self.num_states()))
+        accelerations = np.array(self.actions)
+
+        horizontal_speeds = np.clip(horizontal_speeds[:, np.newaxis] + accelerations[:, 0], 0, self.MAX_SPEED - 1)
+        vertical_speeds = np.clip(vertical_speeds[:, np.newaxis] + accelerations[:, 1], 0, self.MAX_SPEED - 1)
+        vertical_speeds[(horizontal_speeds == 0) & (vertical_speeds == 0)] = 1
+        path = (cols[:, np.newaxis], rows[:, np.newaxis], horizontal_speeds, vertical_speeds)
+
+        finishes = self._finishes[path]
+        crashes = self._crashes[path] & ~finishes
+        next_state_ids = (
+            self._next_cell_ids[path] * self.MAX_SPEED * self.MAX_SPEED +
+            horizontal_speeds * self.MAX_SPEED +
+            vertical_speeds
+        )
+
+        self.next_state_ids = np.where(finishes | crashes, self.RESET_STATE, next_state_ids).astype(np.int32)
+        self.rewards = np.where(finishes, 0, np.where(crashes, -5, -1)).astype(np.int32)
+        self.done = finishes
+
+    def _load_or_compile(self, cache_dir):
+        digest = hashlib.sha1(f'{self.track_hash}:{self.COMPILED_VERSION}:{self.MAX_SPEED}:{self.compact}:{self.swept_collisions}'.encode())
+        cache_path = os.path.join(cache_dir, f'{digest.hexdigest()}.npz')
+
+        if os.path.exists(cache_path):
+            with np.load(cache_path) as tables:
+                self.next_state_ids = tables['next_state_ids']
+                self.rewards = tables['rewards']
+                self.done = tables['done']
+            return
+
+        self.compile()
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temporary file first so a crash never leaves a partial cache
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.npz')
+        with os.fdopen(fd, 'wb') as tmp:
+            np.savez_compressed(tmp, next_state_ids=self.next_state_ids, rewards=self.rewards, done=self.done)
+        os.replace(tmp_path, cache_path)
+
+    def _init_path_tables(self):
+        """
+        Builds lookup tables indexed by [col, row, horizontal_speed,
+        vertical_speed] for a car leaving (col, row) at that speed:
+            _finishes: the car passes through a finish line cell, or with
+                       swept_collisions does so before hitting a wall
+            _hits_wall: the car passes through an off track cell before
+                        reaching the finish line
+            _crashes: the car is sent back to the start, which is _hits_wall
+                      with swept_collisions and otherwise whether the cell
+                      it lands in is off the track
+            _next_cell_ids: the cell id the car lands in, or -1
+
+        The car's path is walked one cell at a time, stepping right while
+        it has more horizontal than vertical speed left and up otherwise.
+        Every car at the same speed takes the same steps, so the tables are
+        built one step at a time for every cell at once.
+        """
+        (num_rows, num_cols) = self.track.shape
+        shape = (num_cols, num_rows, self.MAX_SPEED, self.MAX_SPEED)
+        self._finishes = np.zeros(shape, dtype=bool)
+        self._hits_wall = np.zeros(shape, dtype=bool)
+        self._crashes = np.zeros(shape, dtype=bool)
+        self._next_cell_ids = np.full(shape, -1, dtype=np.int32)
+
+        (cols, rows) = np.meshgrid(np.arange(num_cols), np.arange(num_rows), indexing='ij')
+        for horizontal_speed in range(self.MAX_SPEED):
+            for vertical_speed in range(self.MAX_SPEED):
+                crosses_finish = np.zeros((num_cols, num_rows), dtype=bool)
+                finishes = np.zeros((num_cols, num_rows), dtype=bool)
+                hits_wall = np.zeros((num_cols, num_rows), dtype=bool)
+                for (col_offset, row_offset) in self._path_offsets(horizontal_speed, vertical_speed):
+                    (path_cols, path_rows) = (cols + col_offset, rows + row_offset)
+                    on_grid = (path_cols >= 0) & (path_cols < num_cols) & (path_rows >= 0) & (path_rows < num_rows)
+                    cells = self.track[np.where(on_grid, path_rows, 0), np.where(on_grid, path_cols, 0)]
+                    crosses_finish |= on_grid & (cells == self.FINISH)
+                    finishes |= on_grid & (cells == self.FINISH) & ~hits_wall
+                    hits_wall |= ~(on_grid & (cells != self.OOB)) & ~finishes
+
+                (next_cols, next_rows) = (cols + horizontal_speed, rows - vertical_speed)
+                on_grid = (next_cols >= 0) & (next_cols < num_cols) & (next_rows >= 0) & (next_rows < num_rows)
+                (next_cols, next_rows) = (np.where(on_grid, next_cols, 0), np.where(on_grid, next_rows, 0))
+                lands_off_track = ~on_grid | (self.track[next_rows, next_cols] == self.OOB)
+
+                self._hits_wall[:, :, horizontal_speed, vertical_speed] = hits_wall
+                if self.swept_collisions:
+                    self._finishes[:, :, horizontal_speed, vertical_speed] = finishes
+                    self._crashes[:, :, horizontal_speed, vertical_speed] = hits_wall
+                else:
+                    self._finishes[:, :, horizontal_speed, vertical_speed] = crosses_finish
+                    self._crashes[:, :, horizontal_speed, vertical_speed] = lands_off_track
+                self._next_cell_ids[:, :, horizontal_speed, vertical_speed] = np.where(
+                    on_grid, self._cell_ids[next_cols, next_rows], -1
+                )
+
+    @staticmethod
+    def _path_offsets(horizontal_speed, vertical_speed):
+        """
+        Returns the (col, row) offsets of the cells a car moving at this
+        speed passes through, in order, ending at the cell it lands in.
+        """
+        offsets = []
+        (col_offset, row_offset) = (0, 0)
+        while horizontal_speed + vertical_speed > 0:
+            if horizontal_speed >= vertical_speed:
+                col_offset += 1
+                horizontal_speed -= 1
             else:
-                intermediate_location[1] -=1
-                vertical -= 1
-            for finish_location in self.finish_locations:
-                if intermediate_location[0] == finish_location[0] and intermediate_location[1] == finish_location[1]:
-                    return True
-        return False
+                row_offset -= 1
+                vertical_speed -= 1
+            offsets.append((col_offset, row_offset))
+        return offsets
+
+    def crosses_finish_line(self, position, speed):
+        return bool(self._finishes[position[0], position[1], speed[0], speed[1]])
+
+    def hits_wall(self, position, speed):
+        """
+        Returns whether a car leaving position at speed passes through an
+        off track cell before reaching the finish line.
+        """
+        return bool(self._hits_wall[position[0], position[1], speed[0], speed[1]])
 
     def out_of_bounds(self, location):
         return (location[0] < 0 or location[0] >= self.dimensions[0] or
                 location[1] < 0 or location[1] >= self.dimensions[1] or
-                self.track[location[1]][location[0]] == self.OOB)
+                self.track[location[1], location[0]] == self.OOB)
 
     def get_next_location(self, location, speed):
         next_loc = [location[0] + speed[0], location[1] - speed[1]]
@@ -147,6 +334,16 @@ class RaceTrack:
     def get_starting_state(self):
         return self.state_to_id(self.starting_line_state())
 
+    def get_starting_states(self, num_states, rng=None):
+        """
+        Returns an array of num_states random starting line state ids.
+        """
+        if rng is None:
+            choices = np.random.randint(0, len(self.start_state_ids), size=num_states)
+        else:
+            choices = rng.integers(0, len(self.start_state_ids), size=num_states)
+        return self.start_state_ids[choices]
+
     def starting_line_state(self):
         random_start = self.start_locations[random.randint(0, len(self.start_locations) - 1)]
         ret = (random_start[0], random_start[1], 0, 0)
@@ -154,7 +351,7 @@ class RaceTrack:
 
     @property
     def dimensions(self):
-        return (len(self.track[0]), len(self.track))
+        return (self.track.shape[1], self.track.shape[0])
 
 
 class RaceTrackGame:
@@ -181,12 +378,12 @@ class RaceTrackGame:
 
     TRACK_SIZE = (SCREEN_SIZE[0] - 2 * LEFT_RIGHT_MARGIN, SCREEN_SIZE[1] - FONT_HEIGHT - 2 * TOP_BOTTOM_MARGIN)
 
-    def __init__(self, racetrack_csv):
+    def __init__(self, racetrack_csv, compact=False):
         self.screen = pygame.display.get_surface()
         self.screen_rect = self.screen.get_rect()
         self.done = False
         self.keys = pygame.key.get_pressed()
-        self.racetrack = RaceTrack(racetrack_csv)
+        self.racetrack = RaceTrack(racetrack_csv, compact=compact)
         self.current_action = [0, 0]
         self.font = pygame.font.SysFont(pygame.font.get_default_font(), self.FONT_SIZE)
 
@@ -247,9 +444,10 @@ class RaceTrackGame:
         self.screen.blit(text_surface, (self.SCREEN_SIZE[0] - self.SPEED_RIGHT_MARGIN, 10))
 
     def render_track(self):
-        for row in range(len(self.racetrack.track)):
-            for col in range(len(self.racetrack.track[row])):
-                cell = self.racetrack.track[row][col]
+        (num_rows, num_cols) = self.racetrack.track.shape
+        for row in range(num_rows):
+            for col in range(num_cols):
+                cell = self.racetrack.track[row, col]
                 self.draw_cell(cell, col, row)
 
     def render_car(self, location):
@@ -328,11 +526,10 @@ class RaceTrackGame:
         sys.exit()
 
     @staticmethod
-    def bot_run(racetrack_file, policy_file, episodes=10, timestep=1):
+    def bot_run(racetrack_file, policy_file, episodes=10, timestep=1, compact=False):
         RaceTrackGame.init()
-        policy = np.load(policy_file)
-        bot = RacerBot(policy)
-        game = RaceTrackGame(racetrack_file)
+        game = RaceTrackGame(racetrack_file, compact=compact)
+        bot = RacerBot(load_policy(policy_file, game.racetrack))
         game.bot_loop(bot, episodes, timestep)
         RaceTrackGame.quit()
 
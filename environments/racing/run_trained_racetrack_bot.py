@@ -22,6 +22,9 @@ parser.add_argument('--verbose',
                     type=bool,
                     help='Print (a lot of) log messages',
                     default=False)
+parser.add_argument('--compact',
+                    action='store_true',
+                    help='The policy was trained with compact state ids')
 args = parser.parse_args()
 
-RaceTrackGame.bot_run(args.racetrack, args.policy, episodes=args.episodes, timestep=args.timestep)
+RaceTrackGame.bot_run(args.racetrack, args.policy, episodes=args.episodes, timestep=args.timestep, compact=args.compact)
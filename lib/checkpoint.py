@@ -0,0 +1,96 @@
+"""
+Training checkpoints
+
+A checkpoint is an .npz file holding the Q and N tables, the number of
+episodes trained so far, the state of the global numpy.random and random
+generators (which is what the tabular learners sample from) and any extra
+arrays a learner needs to carry on where it left off.
+
+Checkpoints are compressed by default, which keeps them small. For large
+tracks, save them uncompressed (compress=False, or --no-compress in the
+training scripts): they're bigger on disk, but resuming memory-maps Q and N
+instead of inflating a full copy of them.
+
+Resuming from a checkpoint file that doesn't exist yet starts training
+from scratch, so a training script can always be run with --resume.
+"""
+import os
+import random
+
+import numpy as np
+
+from lib.npz import load_npz, save_npz
+
+
+def _random_states():
+    (name, keys, pos, has_gauss, cached_gaussian) = np.random.get_state()
+    (version, internal_state, gauss_next) = random.getstate()
+    return {
+        '_np_random_keys': keys,
+        '_np_random_params': np.array([pos, has_gauss]),
+        '_np_random_gaussian': np.array(cached_gaussian),
+        '_random_version': np.array(version),
+        '_random_internal_state': np.array(internal_state, dtype=np.int64),
+        '_random_gauss_next': np.array(np.nan if gauss_next is None else gauss_next),
+    }
+
+
+def _restore_random_states(arrays):
+    (pos, has_gauss) = arrays['_np_random_params']
+    np.random.set_state((
+        'MT19937',
+        np.array(arrays['_np_random_keys'], dtype=np.uint32),
+        int(pos),
+        int(has_gauss),
+        float(arrays['_np_random_gaussian'])
+    ))
+    gauss_next = float(arrays['_random_gauss_next'])
+    random.setstate((
+        int(arrays['_random_version']),
+        tuple(int(x) for x in arrays['_random_internal_state']),
+        None if np.isnan(gauss_next) else gauss_next
+    ))
+
+
+def save_checkpoint(path, Q, N, episode, compress=True, **extra):
+    """
+    Atomically writes Q, N, the episode counter, the random generator
+    states and any extra arrays to path. Uncompressed checkpoints are
+    bigger on disk but can be memory-mapped by load_checkpoint.
+    """
+    arrays = dict(extra)
+    arrays.update(_random_states())
+    arrays['Q'] = Q
+    arrays['N'] = N
+    arrays['episode'] = np.array(episode)
+    save_npz(path, compress, **arrays)
+
+
+def load_checkpoint(path, mmap_mode='c'):
+    """
+    Loads a checkpoint written by save_checkpoint and restores the random
+    generator states it recorded.
+
+    Returns a dict with 'Q', 'N', 'episode' and any extra arrays. Arrays
+    stored uncompressed are memory-mapped with mmap_mode rather than read
+    into memory; the default copy-on-write mode lets a learner update them
+    without touching the file. Pass mmap_mode=None to always read them.
+    """
+    checkpoint = load_npz(path, mmap_mode)
+    _restore_random_states(checkpoint)
+    arrays = {name: value for name, value in checkpoint.items() if not name.startswith('_')}
+    arrays['episode'] = int(arrays['episode'])
+    return arrays
+
+
+def resume_checkpoint(path):
+    """
+    Loads the checkpoint a learner was asked to resume from, like
+    load_checkpoint, or returns None if there's no file at path yet.
+    """
+    if path is None:
+        raise ValueError('resume requires a checkpoint path')
+    if not os.path.exists(path):
+        print(f'No checkpoint at {path}, starting from scratch')
+        return None
+    return load_checkpoint(path)
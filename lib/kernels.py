@@ -0,0 +1,186 @@
+"""
+Compiled inner loops for the tabular learners
+
+When numba is installed, td.sarsa, td.q_learning and
+mc.on_policy_fv_mc_e_soft_control run whole episodes in the kernels below
+on environments with compiled transition tables (see RaceTrack.compile).
+Without numba, or for other environments, they fall back to their plain
+Python loops.
+
+The kernels draw from numba's own random generator, which is seeded from
+numpy.random with seed() when a learner starts and every checkpoint_every
+episodes, so runs stay reproducible and resumable. That reseeding
+happens whether or not a checkpoint is written, so on this path
+checkpoint_every changes the results by itself: two runs only match if
+they use the same checkpoint_every. The random stream also differs from
+the Python loops, so the two backends don't give bit-identical results
+for the same seed.
+"""
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def _jit(function):
+    if numba is None:
+        return function
+    return numba.njit(cache=True)(function)
+
+
+def environment_tables(environment):
+    """
+    Returns the (next_state_ids, rewards, done, start_state_ids) arrays the
+    kernels step through, or None if the kernels can't be used.
+
+    next_state_ids holds a negative id wherever the car goes back to a
+    random starting state.
+    """
+    if numba is None or not getattr(environment, 'compiled', False):
+        return None
+    return (environment.next_state_ids, environment.rewards, environment.done, environment.start_state_ids)
+
+
+def alpha_table(alpha_func, size):
+    """
+    Returns alpha_func(n) for every visit count n below size, so kernels
+    can look step sizes up instead of calling back into Python.
+    """
+    table = np.zeros(size)
+    for n in range(1, size):
+        table[n] = alpha_func(float(n))
+    return table
+
+
+def seed(value):
+    _seed(value)
+
+
+@_jit
+def _seed(value):
+    np.random.seed(value)
+
+
+@_jit
+def _starting_state(start_state_ids):
+    return start_state_ids[np.random.randint(0, len(start_state_ids))]
+
+
+@_jit
+def _epsilon_greedy(Q, s, epsilon):
+    if np.random.random() < epsilon:
+        return np.random.randint(0, Q.shape[1])
+    return np.argmax(Q[s])
+
+
+@_jit
+def _sample(probabilities):
+    cdf = np.cumsum(probabilities)
+    r = np.random.random() * cdf[-1]
+    return min(np.searchsorted(cdf, r, side='right'), len(cdf) - 1)
+
+
+@_jit
+def _step(next_state_ids, start_state_ids, s, a):
+    s_prime = next_state_ids[s, a]
+    if s_prime < 0:
+        s_prime = _starting_state(start_state_ids)
+    return s_prime
+
+
+@_jit
+def sarsa_episodes(next_state_ids, rewards, done, start_state_ids, Q, N, epsilons, alphas,
+                   episode, stop, epsilon, s, a, in_episode):
+    """
+    Runs td.sarsa's episodes from episode up to stop, where epsilons holds
+    epsilon_func for every episode and epsilon is the current one.
+
+    Returns (episode, epsilon, s, a, in_episode). It returns early, part way
+    through an episode, when a visit count is about to outgrow alphas;
+    call it again with its return values once alphas is bigger.
+    """
+    while episode < stop:
+        if not in_episode:
+            s = _starting_state(start_state_ids)
+            a = _epsilon_greedy(Q, s, epsilon)
+            in_episode = True
+        while in_episode:
+            if N[s, a] + 1 >= len(alphas):
+                return episode, epsilon, s, a, in_episode
+            s_prime = _step(next_state_ids, start_state_ids, s, a)
+            in_episode = not done[s, a]
+            N[s, a] += 1
+            epsilon = epsilons[episode]
+            a_prime = _epsilon_greedy(Q, s_prime, epsilon)
+            Q[s, a] += alphas[int(N[s, a])] * (rewards[s, a] + Q[s_prime, a_prime] - Q[s, a])
+            s = s_prime
+            a = a_prime
+        episode += 1
+    return episode, epsilon, s, a, in_episode
+
+
+@_jit
+def q_learning_episodes(next_state_ids, rewards, done, start_state_ids, Q, N, epsilon, alphas,
+                        episode, stop, s, in_episode):
+    """
+    Runs td.q_learning's episodes from episode up to stop.
+
+    Returns (episode, s, in_episode), returning early like sarsa_episodes.
+    """
+    while episode < stop:
+        if not in_episode:
+            s = _starting_state(start_state_ids)
+            in_episode = True
+        while in_episode:
+            # Checked before sampling an action so that returning early
+            # doesn't change the random stream
+            if np.max(N[s]) + 1 >= len(alphas):
+                return episode, s, in_episode
+            a = _epsilon_greedy(Q, s, epsilon)
+            s_prime = _step(next_state_ids, start_state_ids, s, a)
+            in_episode = not done[s, a]
+            N[s, a] += 1
+            Q[s, a] += alphas[int(N[s, a])] * (rewards[s, a] + np.max(Q[s_prime]) - Q[s, a])
+            s = s_prime
+        episode += 1
+    return episode, s, in_episode
+
+
+@_jit
+def soft_policy_episode(next_state_ids, rewards, done, start_state_ids, policy, random_first_action):
+    """
+    Plays one episode from a random starting state following a
+    num_states x num_actions policy, like mc.generate_episode.
+
+    Returns arrays of the state, action and reward at every step.
+    """
+    capacity = 1024
+    states = np.empty(capacity, dtype=np.int64)
+    actions = np.empty(capacity, dtype=np.int64)
+    episode_rewards = np.empty(capacity)
+    steps_taken = 0
+    s = _starting_state(start_state_ids)
+    episode_over = False
+    while not episode_over:
+        if steps_taken == capacity:
+            capacity *= 2
+            states = np.concatenate((states, np.empty_like(states)))
+            actions = np.concatenate((actions, np.empty_like(actions)))
+            episode_rewards = np.concatenate((episode_rewards, np.empty_like(episode_rewards)))
+
+        if steps_taken == 0 and random_first_action:
+            a = np.random.randint(0, policy.shape[1])
+        else:
+            a = _sample(policy[s])
+
+        states[steps_taken] = s
+        actions[steps_taken] = a
+        episode_rewards[steps_taken] = rewards[s, a]
+        episode_over = done[s, a]
+        steps_taken += 1
+
+        s = _step(next_state_ids, start_state_ids, s, a)
+
+    return states[:steps_taken], actions[:steps_taken], episode_rewards[:steps_taken]
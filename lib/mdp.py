@@ -0,0 +1,189 @@
+"""
+Finite MDPs and dynamic programming solvers
+
+A TabularMDP holds the model of a problem with num_states states and
+num_actions actions. The solvers below work on any TabularMDP, so every
+problem that exports one (GridWorld, GamblersProblem, JacksCarRental,
+BlackjackModel) shares them.
+
+A deterministic policy is a num_states array of action indices
+A non-deterministic policy is a num_states x num_actions array
+"""
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+
+
+class TabularMDP:
+    """
+    transitions[a][s, s'] is the probability of moving from s to s' after
+    action a, as a dense array or a scipy.sparse matrix per action. Whatever
+    probability is missing from a row is the chance the episode ends there.
+    rewards[s, a] is the expected immediate reward. allowed[s, a] marks the
+    actions that may be taken in s, and defaults to all of them.
+
+    The transitions are stored stacked into one (num_actions * num_states)
+    x num_states matrix, so backing up every action in every state is a
+    single matrix-vector product.
+    """
+
+    def __init__(self, transitions, rewards, gamma=0.9, allowed=None):
+        self.rewards = np.asarray(rewards, dtype=float)
+        (num_states, num_actions) = self.rewards.shape
+        if len(transitions) != num_actions:
+            raise ValueError(f'Got {len(transitions)} transition matrices for {num_actions} actions')
+        self.sparse = any(scipy.sparse.issparse(t) for t in transitions)
+        if self.sparse:
+            self._transitions = scipy.sparse.vstack(
+                [scipy.sparse.csr_matrix(t) for t in transitions], format='csr'
+            )
+        else:
+            self._transitions = np.concatenate([np.asarray(t, dtype=float) for t in transitions])
+        if self._transitions.shape != (num_actions * num_states, num_states):
+            raise ValueError(f'Transition matrices must each be {num_states} x {num_states}')
+        self.gamma = gamma
+        if allowed is None:
+            allowed = np.ones((num_states, num_actions), dtype=bool)
+        self.allowed = np.asarray(allowed, dtype=bool)
+
+    def num_states(self):
+        return self.rewards.shape[0]
+
+    def num_actions(self):
+        return self.rewards.shape[1]
+
+    def transition_matrix(self, action):
+        """
+        Returns the num_states x num_states matrix P[action].
+        """
+        n = self.num_states()
+        return self._transitions[action * n:(action + 1) * n]
+
+    def action_values(self, value):
+        """
+        Returns the num_states x num_actions array of
+        R(s, a) + gamma * sum_s' p(s'|s, a) V(s'), allowed or not.
+        """
+        future = (self._transitions @ value).reshape(self.num_actions(), self.num_states()).T
+        return self.rewards + self.gamma * future
+
+    def greedy_policy(self, value):
+        """
+        Returns the deterministic policy that is greedy with respect to
+        value among the allowed actions, picking the lowest action on ties.
+        """
+        return np.argmax(self._allowed_values(self.action_values(value)), axis=1)
+
+    def _allowed_values(self, Q):
+        return np.where(self.allowed, Q, -np.inf)
+
+    def policy_model(self, policy):
+        """
+        Returns the num_states x num_states transition matrix and the
+        num_states expected rewards of following policy.
+        """
+        states = np.arange(self.num_states())
+        policy = np.asarray(policy)
+        if policy.ndim == 1:
+            rows = policy.astype(int) * self.num_states() + states
+            return self._transitions[rows], self.rewards[states, policy.astype(int)]
+
+        transitions = sum(
+            scipy.sparse.diags(policy[:, a]) @ self.transition_matrix(a) if self.sparse
+            else policy[:, a, np.newaxis] * self.transition_matrix(a)
+            for a in range(self.num_actions())
+        )
+        return transitions, np.sum(policy * self.rewards, axis=1)
+
+
+def evaluate_policy(mdp, policy, convergence=None, value=None, max_sweeps=None):
+    """
+    Returns the state values of policy.
+
+    :param convergence: If None, solves the linear system V = R + gamma P V
+                        exactly. Otherwise sweeps until no value changes by
+                        more than convergence.
+    :param value: Starting values for the sweeps. Defaults to 0
+    :param max_sweeps: Stop after this many sweeps even if not converged
+    """
+    (transitions, rewards) = mdp.policy_model(policy)
+    if convergence is None:
+        if mdp.sparse:
+            system = scipy.sparse.identity(mdp.num_states(), format='csc') - mdp.gamma * transitions.tocsc()
+            return scipy.sparse.linalg.spsolve(system, rewards)
+        return np.linalg.solve(np.identity(mdp.num_states()) - mdp.gamma * transitions, rewards)
+
+    value = np.zeros(mdp.num_states()) if value is None else np.array(value, dtype=float)
+    sweeps = 0
+    diff = np.inf
+    while diff > convergence and (max_sweeps is None or sweeps < max_sweeps):
+        new_value = rewards + mdp.gamma * (transitions @ value)
+        diff = np.max(np.fabs(new_value - value))
+        value = new_value
+        sweeps += 1
+    return value
+
+
+def value_iteration(mdp, convergence=1e-6, value=None):
+    """
+    Sweeps V(s) = max_a Q(s, a) until no value changes by more than
+    convergence. Returns the values and the greedy policy.
+    """
+    value = np.zeros(mdp.num_states()) if value is None else np.array(value, dtype=float)
+    diff = np.inf
+    while diff > convergence:
+        new_value = np.max(mdp._allowed_values(mdp.action_values(value)), axis=1)
+        diff = np.max(np.fabs(new_value - value))
+        value = new_value
+    return value, mdp.greedy_policy(value)
+
+
+def _improve_policy(mdp, value, policy):
+    """
+    Returns the greedy policy, keeping the current action wherever it is
+    as good as the best one so that ties can't make the policy cycle.
+    """
+    Q = mdp._allowed_values(mdp.action_values(value))
+    greedy = np.argmax(Q, axis=1)
+    states = np.arange(mdp.num_states())
+    keep = np.isclose(Q[states, policy], Q[states, greedy], rtol=1e-9, atol=1e-12)
+    return np.where(keep, policy, greedy)
+
+
+def policy_iteration(mdp, policy=None, evaluation_convergence=None):
+    """
+    Alternates evaluating the policy and making it greedy until it stops
+    changing. Returns the values and the policy.
+
+    :param policy: Deterministic starting policy. Defaults to the first
+                   allowed action in every state
+    :param evaluation_convergence: Passed to evaluate_policy. None solves
+                                   each evaluation exactly
+    """
+    if policy is None:
+        policy = np.argmax(mdp.allowed, axis=1)
+    policy = np.asarray(policy, dtype=int)
+    value = None
+    while True:
+        value = evaluate_policy(mdp, policy, evaluation_convergence, value)
+        new_policy = _improve_policy(mdp, value, policy)
+        if np.array_equal(new_policy, policy):
+            return value, policy
+        policy = new_policy
+
+
+def modified_policy_iteration(mdp, sweeps=10, convergence=1e-6, value=None):
+    """
+    Interleaves one greedy backup with sweeps backups of the greedy policy,
+    stopping once the greedy backup changes no value by more than
+    convergence. sweeps=0 is value iteration and a large sweeps approaches
+    policy iteration. Returns the values and the greedy policy.
+    """
+    value = np.zeros(mdp.num_states()) if value is None else np.array(value, dtype=float)
+    while True:
+        Q = mdp._allowed_values(mdp.action_values(value))
+        policy = np.argmax(Q, axis=1)
+        new_value = np.max(Q, axis=1)
+        if np.max(np.fabs(new_value - value)) <= convergence:
+            return new_value, policy
+        value = evaluate_policy(mdp, policy, convergence=0.0, value=new_value, max_sweeps=sweeps)
@@ -0,0 +1,123 @@
+"""
+A learned model of an environment's transitions, for planning
+"""
+import heapq
+
+import numpy as np
+
+
+class TabularModel:
+    """
+    Remembers the last reward, next state and done flag seen after every
+    (state, action) pair, in flat arrays indexed by
+    pair = state * num_actions + action. Keeping only the last transition is
+    exact for deterministic environments, such as the racetrack away from
+    its random restarts, and an approximation otherwise.
+
+    Each pair also sits in a doubly linked list, stored in arrays, of the
+    pairs that lead to its next state, so the predecessors of a state can be
+    listed without scanning the model. Pairs that end the episode have no
+    next state and aren't in any list.
+    """
+
+    def __init__(self, shape, capacity=1024):
+        (num_states, self.num_actions) = shape
+        num_pairs = num_states * self.num_actions
+        self.rewards = np.zeros(num_pairs)
+        self.next_states = np.full(num_pairs, -1, dtype=np.int64)
+        self.done = np.zeros(num_pairs, dtype=bool)
+        self.known = np.zeros(num_pairs, dtype=bool)
+        # Every known pair, so they can be sampled uniformly
+        self.pairs = np.zeros(capacity, dtype=np.int64)
+        self.num_known = 0
+        self._first_predecessor = np.full(num_states, -1, dtype=np.int64)
+        self._next_predecessor = np.full(num_pairs, -1, dtype=np.int64)
+        self._previous_predecessor = np.full(num_pairs, -1, dtype=np.int64)
+
+    def update(self, state, action, reward, next_state, done):
+        pair = state * self.num_actions + action
+        if not self.known[pair]:
+            self.known[pair] = True
+            if self.num_known == len(self.pairs):
+                self.pairs = np.concatenate((self.pairs, np.zeros_like(self.pairs)))
+            self.pairs[self.num_known] = pair
+            self.num_known += 1
+        elif not self.done[pair]:
+            if self.next_states[pair] == next_state and not done:
+                self.rewards[pair] = reward
+                return
+            self._unlink(pair)
+
+        self.rewards[pair] = reward
+        self.next_states[pair] = -1 if done else next_state
+        self.done[pair] = done
+        if not done:
+            self._link(pair, next_state)
+
+    def _link(self, pair, state):
+        first = self._first_predecessor[state]
+        self._next_predecessor[pair] = first
+        self._previous_predecessor[pair] = -1
+        if first >= 0:
+            self._previous_predecessor[first] = pair
+        self._first_predecessor[state] = pair
+
+    def _unlink(self, pair):
+        previous = self._previous_predecessor[pair]
+        following = self._next_predecessor[pair]
+        if previous >= 0:
+            self._next_predecessor[previous] = following
+        else:
+            self._first_predecessor[self.next_states[pair]] = following
+        if following >= 0:
+            self._previous_predecessor[following] = previous
+
+    def sample(self, count):
+        """
+        Returns arrays of the states, actions, rewards, next states and done
+        flags of count known pairs, drawn uniformly with replacement.
+        """
+        pairs = self.pairs[np.random.randint(0, self.num_known, size=count)]
+        (states, actions) = np.divmod(pairs, self.num_actions)
+        return states, actions, self.rewards[pairs], self.next_states[pairs], self.done[pairs]
+
+    def predecessors(self, state):
+        """
+        Returns an array of the pairs last seen leading to state.
+        """
+        pairs = []
+        pair = self._first_predecessor[state]
+        while pair >= 0:
+            pairs.append(pair)
+            pair = self._next_predecessor[pair]
+        return np.array(pairs, dtype=np.int64)
+
+
+class PairQueue:
+    """
+    A max-priority queue of (state, action) pairs, as flat pair indices,
+    holding each pair at most once.
+
+    Pushing a queued pair only raises its priority. Superseded heap entries
+    are skipped when they come up.
+    """
+
+    def __init__(self, num_pairs):
+        self._heap = []
+        self._priorities = np.zeros(num_pairs)
+
+    def push(self, pair, priority):
+        if priority > self._priorities[pair]:
+            self._priorities[pair] = priority
+            heapq.heappush(self._heap, (-priority, int(pair)))
+
+    def pop(self):
+        """
+        Returns the pair with the highest priority, or None if it's empty.
+        """
+        while self._heap:
+            (priority, pair) = heapq.heappop(self._heap)
+            if -priority == self._priorities[pair]:
+                self._priorities[pair] = 0.0
+                return pair
+        return None
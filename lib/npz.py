@@ -0,0 +1,74 @@
+"""
+Saving and loading .npz archives
+
+save_npz writes atomically, and load_npz memory-maps every array that was
+stored uncompressed instead of reading it into memory.
+"""
+import os
+import tempfile
+import zipfile
+
+import numpy as np
+
+
+def save_npz(path, compress=True, **arrays):
+    """
+    Atomically writes arrays to the .npz file at path.
+
+    The file is written next to path and then renamed over it, so a crash
+    or Ctrl-C part way through never leaves a truncated file. Uncompressed
+    archives are bigger on disk but can be memory-mapped by load_npz.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.npz')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            if compress:
+                np.savez_compressed(tmp, **arrays)
+            else:
+                np.savez(tmp, **arrays)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _memmap_member(path, archive, info, mmap_mode):
+    """
+    Memory-maps an uncompressed .npy member of an .npz file in place.
+    """
+    with open(path, 'rb') as f:
+        # The local file header is 30 bytes followed by the file name and
+        # an extra field whose lengths are stored at offsets 26 and 28
+        f.seek(info.header_offset + 26)
+        name_length = int.from_bytes(f.read(2), 'little')
+        extra_length = int.from_bytes(f.read(2), 'little')
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            (shape, fortran_order, dtype) = np.lib.format.read_array_header_1_0(f)
+        else:
+            (shape, fortran_order, dtype) = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    if dtype.hasobject or 0 in shape or shape == ():
+        return archive[info.filename[:-len('.npy')]]
+    order = 'F' if fortran_order else 'C'
+    return np.memmap(path, dtype=dtype, mode=mmap_mode, offset=offset, shape=shape, order=order)
+
+
+def load_npz(path, mmap_mode='r'):
+    """
+    Returns a dict of the arrays in the .npz file at path.
+
+    Arrays stored uncompressed are memory-mapped with mmap_mode rather than
+    read into memory. Pass mmap_mode=None to always read them.
+    """
+    arrays = {}
+    with np.load(path) as archive, zipfile.ZipFile(path) as zf:
+        for info in zf.infolist():
+            name = info.filename[:-len('.npy')]
+            if mmap_mode is not None and info.compress_type == zipfile.ZIP_STORED:
+                arrays[name] = _memmap_member(path, archive, info, mmap_mode)
+            else:
+                arrays[name] = archive[name]
+    return arrays
@@ -1,14 +1,20 @@
 import numpy as np
 
+from lib.sampling import sample, sample_batch
+
 
 def sample_action(policy, state):
     """
     Samples a policy for an action given the current state.
     """
-    choices = np.arange(0, policy.shape[1])
-    probabilities = policy[state]
+    return sample(policy[state])
+
 
-    return np.random.choice(choices, p=probabilities)
+def sample_actions(policy, states):
+    """
+    Samples a policy for one action per state in an array of states.
+    """
+    return sample_batch(policy[states])
 
 
 def get_epsilon_greedy_policy(Q, epsilon):
@@ -22,4 +28,38 @@ def get_epsilon_greedy_policy(Q, epsilon):
 
 
 def get_greedy_policy(Q):
-    return np.argmax(Q, axis=1)
\ No newline at end of file
+    return np.argmax(Q, axis=1)
+
+
+class EpsilonGreedyPolicy:
+    """
+    An epsilon greedy policy over Q that is never built as a matrix.
+
+    Sampling an action only looks at Q[state], so it costs O(num_actions)
+    however many states there are. Q is held by reference, so updates to it
+    are picked up immediately.
+    """
+
+    def __init__(self, Q, epsilon):
+        self.Q = Q
+        self.epsilon = epsilon
+
+    def sample_action(self, state):
+        if np.random.random() < self.epsilon:
+            return np.random.randint(0, self.Q.shape[1])
+        return np.argmax(self.Q[state])
+
+    def sample_actions(self, states):
+        """
+        Samples one action for each state in an array of states.
+        """
+        explore = np.random.random(len(states)) < self.epsilon
+        random_actions = np.random.randint(0, self.Q.shape[1], size=len(states))
+        greedy_actions = np.argmax(self.Q[states], axis=1)
+        return np.where(explore, random_actions, greedy_actions)
+
+    def to_matrix(self):
+        """
+        Builds the dense num_states x num_actions policy.
+        """
+        return get_epsilon_greedy_policy(self.Q, self.epsilon)
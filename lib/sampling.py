@@ -0,0 +1,99 @@
+"""
+Categorical sampling
+
+Every sampler takes an optional rng, a numpy Generator. When it is None
+the global numpy.random state is used.
+"""
+import numpy as np
+
+
+def _uniform(rng, size=None):
+    if rng is None:
+        return np.random.random(size)
+    return rng.random(size)
+
+
+def sample_cdf(cdf, rng=None):
+    """
+    Samples an index from a cumulative distribution by binary search.
+
+    The cdf does not need to end exactly at 1; the uniform draw is scaled
+    to its last entry so unnormalised weights work too.
+    """
+    r = _uniform(rng) * cdf[-1]
+    index = np.searchsorted(cdf, r, side='right')
+    # Guard against r landing exactly on the last entry
+    return min(index, len(cdf) - 1)
+
+
+def sample(probabilities, rng=None):
+    """
+    Samples an index from a probability vector in O(log n) after the O(n)
+    cumulative sum. Use an AliasTable if the same distribution is sampled
+    many times.
+    """
+    return sample_cdf(np.cumsum(probabilities), rng)
+
+
+def sample_batch(probabilities, rng=None):
+    """
+    Samples one index per row of a num_rows x n probability matrix.
+
+    All rows are searched at once: row i's cdf is shifted up by i so the
+    flattened cdfs form one sorted array, and a single searchsorted call
+    finds every sample.
+    """
+    num_rows, n = probabilities.shape
+    cdfs = np.cumsum(probabilities, axis=1)
+    totals = cdfs[:, -1]
+    offsets = np.arange(num_rows)
+    shifted = (cdfs / totals[:, np.newaxis] + offsets[:, np.newaxis]).ravel()
+    r = _uniform(rng, num_rows) + offsets
+    indices = np.searchsorted(shifted, r, side='right') - offsets * n
+    return np.minimum(indices, n - 1)
+
+
+class AliasTable:
+    """
+    Walker's alias method (Vose's construction) for a fixed distribution.
+
+    Building the table is O(n), after which every sample is O(1).
+    """
+
+    def __init__(self, probabilities):
+        probabilities = np.asarray(probabilities, dtype=float)
+        n = len(probabilities)
+        scaled = probabilities * n / probabilities.sum()
+        self.probability = np.ones(n)
+        self.alias = np.arange(n)
+
+        small = [i for i in range(n) if scaled[i] < 1.0]
+        large = [i for i in range(n) if scaled[i] >= 1.0]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            self.probability[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] = scaled[l] + scaled[s] - 1.0
+            if scaled[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+        # Whatever is left over is 1 up to rounding error, so it keeps
+        # probability 1 and aliases itself.
+
+    def __len__(self):
+        return len(self.probability)
+
+    def sample(self, size=None, rng=None):
+        """
+        Draws one index, or an array of size indices.
+        """
+        n = len(self.probability)
+        r = _uniform(rng, size) * n
+        column = np.minimum(np.floor(r).astype(int), n - 1)
+        use_alias = (r - column) >= self.probability[column]
+        samples = np.where(use_alias, self.alias[column], column)
+        if size is None:
+            return int(samples)
+        return samples
@@ -0,0 +1,74 @@
+import numpy as np
+
+
+class EligibilityTraces:
+    """
+    Eligibility traces over (state, action) pairs, holding only the pairs
+    whose trace is at least threshold.
+
+    The active pairs and their traces are kept packed at the front of two
+    preallocated arrays, with a per-pair slot index to find them, so a step
+    only touches recently visited pairs however big the state space is.
+
+    :param shape: (num_states, num_actions) of the Q the traces are for
+    :param decay: What every trace is multiplied by each step, gamma * lambda
+    :param threshold: Traces below this are dropped
+    :param replacing: If True, visiting a pair sets its trace to 1.
+                      Otherwise visits accumulate
+    :param capacity: Starting size of the arrays, which double when full
+    """
+
+    def __init__(self, shape, decay, threshold=1e-3, replacing=True, capacity=256):
+        self.num_actions = shape[1]
+        self.decay_rate = decay
+        self.threshold = threshold
+        self.replacing = replacing
+        self.pairs = np.zeros(capacity, dtype=np.int64)
+        self.values = np.zeros(capacity)
+        self._slots = np.full(shape[0] * shape[1], -1, dtype=np.int64)
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def clear(self):
+        self._slots[self.pairs[:self._count]] = -1
+        self._count = 0
+
+    def visit(self, state, action):
+        pair = state * self.num_actions + action
+        slot = self._slots[pair]
+        if slot >= 0:
+            self.values[slot] = 1.0 if self.replacing else self.values[slot] + 1.0
+            return
+        if self._count == len(self.pairs):
+            self.pairs = np.concatenate((self.pairs, np.zeros_like(self.pairs)))
+            self.values = np.concatenate((self.values, np.zeros_like(self.values)))
+        self.pairs[self._count] = pair
+        self.values[self._count] = 1.0
+        self._slots[pair] = self._count
+        self._count += 1
+
+    def update(self, Q, step):
+        """
+        Adds step times its trace to every active pair's entry in Q.
+        """
+        pairs = self.pairs[:self._count]
+        Q.reshape(-1)[pairs] += step * self.values[:self._count]
+
+    def decay(self):
+        """
+        Decays every trace, dropping the ones that fall below threshold.
+        """
+        values = self.values[:self._count]
+        values *= self.decay_rate
+        keep = values >= self.threshold
+        if np.all(keep):
+            return
+        pairs = self.pairs[:self._count]
+        self._slots[pairs] = -1
+        kept = np.count_nonzero(keep)
+        self.pairs[:kept] = pairs[keep]
+        self.values[:kept] = values[keep]
+        self._count = kept
+        self._slots[self.pairs[:kept]] = np.arange(kept)
@@ -0,0 +1,77 @@
+import numpy as np
+
+
+class TrajectoryBuffer:
+    """
+    A fixed-size ring buffer of the last n (state, action, reward) steps of
+    an episode, for n-step methods.
+
+    reward_sum() is the discounted sum of the rewards held, oldest first.
+    It is kept as two stacks so that no step ever divides by gamma: the
+    older steps hold precomputed suffix sums, and the newer steps a running
+    sum that is folded into suffix sums once the older ones run out. Each
+    step is folded in once, so append, pop_oldest and reward_sum are all
+    O(1) amortized whatever n is.
+    """
+
+    def __init__(self, n, gamma=1.0):
+        self.n = n
+        self.gamma = gamma
+        self.states = np.zeros(n, dtype=int)
+        self.actions = np.zeros(n, dtype=int)
+        self.rewards = np.zeros(n)
+        # Discounted sum from each older step to the end of the older steps
+        self._suffix_sums = np.zeros(n)
+        self._discounts = gamma ** np.arange(n + 1)
+        self.clear()
+
+    def clear(self):
+        self._head = 0
+        # Steps [head, split) are the older stack and [split, tail) the newer
+        self._split = 0
+        self._tail = 0
+        self._newer_sum = 0.0
+
+    def __len__(self):
+        return self._tail - self._head
+
+    def append(self, state, action, reward):
+        if len(self) == self.n:
+            raise IndexError('TrajectoryBuffer is full')
+        i = self._tail % self.n
+        self.states[i] = state
+        self.actions[i] = action
+        self.rewards[i] = reward
+        self._newer_sum += self._discounts[self._tail - self._split] * reward
+        self._tail += 1
+
+    def oldest(self):
+        """
+        Returns the state and action of the oldest step.
+        """
+        i = self._head % self.n
+        return self.states[i], self.actions[i]
+
+    def pop_oldest(self):
+        if self._head == self._split:
+            self._fold()
+        self._head += 1
+
+    def reward_sum(self):
+        if self._head == self._split:
+            self._fold()
+        older = self._suffix_sums[self._head % self.n]
+        return older + self._discounts[self._split - self._head] * self._newer_sum
+
+    def _fold(self):
+        """
+        Turns the newer steps into the older stack by computing their
+        suffix sums, newest first.
+        """
+        suffix_sum = 0.0
+        for t in range(self._tail - 1, self._split - 1, -1):
+            i = t % self.n
+            suffix_sum = self.rewards[i] + self.gamma * suffix_sum
+            self._suffix_sums[i] = suffix_sum
+        self._split = self._tail
+        self._newer_sum = 0.0
@@ -13,11 +13,15 @@ parser.add_argument('--verbose',
                     type=bool,
                     help='Print (a lot of) log messages',
                     default=False)
+parser.add_argument('--batch-size',
+                    type=int,
+                    help='Number of episodes to play at once',
+                    default=10000)
 args = parser.parse_args()
 
 
 blackjack = Blackjack(verbose=args.verbose)
-optimal_policy, Q = mc.det_policy_improvement(blackjack, iterations=args.iterations)
+optimal_policy, Q = mc.det_policy_improvement_batch(blackjack, iterations=args.iterations, batch_size=args.batch_size)
 
 if args.verbose:
     for state_id in range(optimal_policy.shape[0]):
@@ -1,6 +1,6 @@
+from environments.racing.policy_file import save_policy
 from environments.racing.racing import RaceTrack
 from monte_carlo import mc
-import numpy as np
 import argparse
 
 
@@ -20,15 +20,37 @@ parser.add_argument('--verbose',
                     type=bool,
                     help='Print (a lot of) log messages',
                     default=False)
+parser.add_argument('--checkpoint',
+                    type=str,
+                    help='Path at which to periodically save a training checkpoint',
+                    default=None)
+parser.add_argument('--checkpoint-every',
+                    type=int,
+                    help='Number of episodes between checkpoints',
+                    default=1000)
+parser.add_argument('--resume',
+                    action='store_true',
+                    help='Resume training from the checkpoint, if it exists')
+parser.add_argument('--no-compress',
+                    action='store_true',
+                    help='Store checkpoints uncompressed, so resuming memory-maps Q and N; '
+                         'recommended for large tracks')
+parser.add_argument('--compact',
+                    action='store_true',
+                    help='Only index states a car can be in, to shrink Q')
 args = parser.parse_args()
 
 
-racetrack = RaceTrack(args.racetrack)
+racetrack = RaceTrack(args.racetrack, compiled=True, compact=args.compact)
 policy, Q = mc.on_policy_fv_mc_e_soft_control(
     racetrack,
     epsilon_func=lambda ep, eps: 1 - (ep/eps),
     alpha_func=lambda n: 0.1,
-    episodes=args.episodes
+    episodes=args.episodes,
+    checkpoint=args.checkpoint,
+    checkpoint_every=args.checkpoint_every,
+    resume=args.resume,
+    compress=not args.no_compress
 )
 
-np.save(args.policy, policy)
+save_policy(args.policy, policy, racetrack)
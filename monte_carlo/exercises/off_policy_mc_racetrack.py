@@ -0,0 +1,37 @@
+from environments.racing.policy_file import save_policy
+from environments.racing.racing import RaceTrack
+from lib.policy import get_epsilon_greedy_policy
+from monte_carlo import mc
+import argparse
+
+
+parser = argparse.ArgumentParser(description='Off-Policy Monte Carlo Racetrack Control')
+
+parser.add_argument('racetrack',
+                    type=str,
+                    help='Path to racetrack csv file')
+parser.add_argument('policy',
+                    type=str,
+                    help='Path at which to save policy file')
+parser.add_argument('--episodes',
+                    type=int,
+                    help='Number of episodes to train over',
+                    default=10000)
+parser.add_argument('--epsilon',
+                    type=float,
+                    help='Exploration rate of the behaviour policy',
+                    default=0.1)
+parser.add_argument('--compact',
+                    action='store_true',
+                    help='Only index states a car can be in, to shrink Q')
+args = parser.parse_args()
+
+
+racetrack = RaceTrack(args.racetrack, compiled=True, compact=args.compact)
+greedy_policy, Q = mc.off_policy_mc_control(
+    racetrack,
+    epsilon=args.epsilon,
+    episodes=args.episodes
+)
+
+save_policy(args.policy, get_epsilon_greedy_policy(Q, 0.0), racetrack)
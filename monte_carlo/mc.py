@@ -8,13 +8,19 @@ An environment is assumed to support the following operations:
     environment.perform_action(a): Returns a reward and the next state (r, s')
     environment.is_terminal(s): Returns whether a state is terminal or not
 
+The batched methods also need:
+    environment.perform_action_batch(s, a, rng): perform_action for arrays of states
+                                                 and actions, returning arrays (r, s', done)
+
 A deterministic policy is a environment.num_states x 1 array
 A non-deterministic policy is a environment.num_states x environment.num_actions array
 """
 import numpy as np
 from tqdm import tqdm
 
-from lib.policy import sample_action, get_greedy_policy
+from lib import kernels
+from lib.checkpoint import resume_checkpoint, save_checkpoint
+from lib.policy import sample_action, get_greedy_policy, EpsilonGreedyPolicy
 
 
 def det_policy_improvement(environment, iterations=100000):
@@ -24,59 +30,171 @@ def det_policy_improvement(environment, iterations=100000):
 
     for i in tqdm(range(iterations)):
 
-        states_seen = one_episode_state_action_values(environment, lambda s: policy[s], random_start=True)
+        (states, actions, gains) = one_episode_state_action_values(environment, lambda s: policy[s], random_start=True)
 
-        for state, actions_performed in states_seen.items():
-            for action, gain in actions_performed.items():
-                N[state, action] = N[state, action] + 1
-                Q[state, action] = Q[state, action] + (1.0/(N[state, action]))*(gain - Q[state, action])
+        N[states, actions] = N[states, actions] + 1
+        Q[states, actions] = Q[states, actions] + (1.0/(N[states, actions]))*(gains - Q[states, actions])
 
         policy = get_greedy_policy(Q)
 
     return policy, Q
 
 
-def one_episode_state_action_values(environment, policy, random_start=True):
-    s = environment.get_starting_state()
-    states_seen = {}
-    first_action = True
-    episode_over = False
+def det_policy_improvement_batch(environment, iterations=100000, batch_size=10000, rng=None):
+    """
+    det_policy_improvement for environments with short episodes, playing
+    batch_size exploring-start episodes at a time with
+    environment.perform_action_batch. Q is the average of every first-visit
+    return seen so far, and the policy is made greedy after each batch.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    num_states = environment.num_states()
+    num_actions = environment.num_actions()
+    policy = np.zeros(num_states, dtype=int)
+    Q = np.zeros(num_states * num_actions)
+    N = np.zeros(num_states * num_actions)
+
+    for start in tqdm(range(0, iterations, batch_size)):
+        num_episodes = min(batch_size, iterations - start)
+        (pairs, rewards) = generate_episode_batch(environment, policy, num_episodes, rng)
+        gains = np.cumsum(rewards[:, ::-1], axis=1)[:, ::-1]
+
+        # Tag each state-action pair with its episode so first visits are per episode
+        episodes = np.arange(num_episodes)[:, np.newaxis]
+        played = np.flatnonzero(pairs.ravel() >= 0)
+        keys = (episodes * num_states * num_actions + pairs).ravel()[played]
+        first = played[first_visits(keys)]
+
+        visits = np.bincount(pairs.ravel()[first], minlength=num_states * num_actions)
+        total_gains = np.bincount(pairs.ravel()[first], weights=gains.ravel()[first], minlength=num_states * num_actions)
+        seen = visits > 0
+        Q[seen] = (Q[seen] * N[seen] + total_gains[seen]) / (N[seen] + visits[seen])
+        N += visits
+
+        policy = get_greedy_policy(Q.reshape(num_states, num_actions))
+
+    return policy, Q.reshape(num_states, num_actions)
+
+
+def generate_episode_batch(environment, policy, num_episodes, rng):
+    """
+    Plays num_episodes exploring-start episodes side by side, following the
+    deterministic policy after a random first state and action.
+
+    Returns two num_episodes x T arrays, where T is the longest episode:
+    the state-action pair (state * num_actions + action) and the reward at
+    each step. Steps after an episode is over have pair -1 and reward 0.
+    """
+    num_actions = environment.num_actions()
+    s = rng.integers(0, environment.num_states(), size=num_episodes)
+    a = rng.integers(0, num_actions, size=num_episodes)
+    playing = np.arange(num_episodes)
+    pairs = []
+    rewards = []
+    while len(playing) > 0:
+        step_pairs = np.full(num_episodes, -1)
+        step_rewards = np.zeros(num_episodes)
+        step_pairs[playing] = s * num_actions + a
+
+        (r, s_prime, episode_over) = environment.perform_action_batch(s, a, rng)
+
+        step_rewards[playing] = r
+        pairs.append(step_pairs)
+        rewards.append(step_rewards)
+
+        playing = playing[~episode_over]
+        s = s_prime[~episode_over]
+        a = policy[s]
+
+    return np.stack(pairs, axis=1), np.stack(rewards, axis=1)
+
+
+def generate_episode(environment, policy, s, random_first_action=False):
+    """
+    Plays one episode starting from state s, following policy(s).
+
+    Returns arrays of the state, action and reward at every step.
+    """
+    capacity = 1024
+    states = np.empty(capacity, dtype=int)
+    actions = np.empty(capacity, dtype=int)
+    rewards = np.empty(capacity)
     steps_taken = 0
+    episode_over = False
     while not episode_over:
-        # If this is the first time we've seen this state
-        if states_seen.get(s, None) is None:
-            states_seen[s] = {}
+        if steps_taken == capacity:
+            capacity *= 2
+            states = np.resize(states, capacity)
+            actions = np.resize(actions, capacity)
+            rewards = np.resize(rewards, capacity)
 
-        if first_action and random_start:
+        if steps_taken == 0 and random_first_action:
             a = np.random.randint(0, environment.num_actions())
-            first_action = False
         else:
-            # Perform our action
             a = policy(s)
 
-        # If this is the first time we've performed this action
-        # in this state
-        if states_seen[s].get(a, None) is None:
-            states_seen[s][a] = 0
-
         (r, s_prime, episode_over) = environment.perform_action(s, a)
 
-        # Update our gain counters
-        states_seen = \
-            {
-                state: {action: gain + r for action, gain in actions_performed.items()}
-                for state, actions_performed
-                in states_seen.items()
-            }
-
+        states[steps_taken] = s
+        actions[steps_taken] = a
+        rewards[steps_taken] = r
         steps_taken += 1
 
-        # Update current state
         s = s_prime
 
-    print(f'{steps_taken}')
+    return states[:steps_taken], actions[:steps_taken], rewards[:steps_taken]
+
 
-    return states_seen
+def discounted_returns(rewards, gamma=1.0):
+    """
+    Returns the (discounted) return following every step of an episode.
+
+    For gamma = 1 this is a reverse cumulative sum. Otherwise each reward is
+    scaled by gamma**t before the reverse cumulative sum and the result is
+    scaled back by gamma**-t. That is done in blocks short enough that
+    gamma**-t can't overflow, carrying the return from one block to the next.
+    """
+    if gamma == 1.0:
+        return np.cumsum(rewards[::-1])[::-1]
+    if gamma == 0.0:
+        # Every return is just the reward that follows
+        return np.array(rewards, dtype=float)
+
+    returns = np.empty(len(rewards))
+    block = max(1, int(100 / -np.log(gamma)))
+    carry = 0.0
+    for end in range(len(rewards), 0, -block):
+        begin = max(0, end - block)
+        discounts = gamma ** np.arange(end - begin)
+        block_returns = np.cumsum((rewards[begin:end] * discounts)[::-1])[::-1] / discounts
+        returns[begin:end] = block_returns + carry * gamma * (gamma ** np.arange(end - begin))[::-1]
+        carry = returns[begin]
+    return returns
+
+
+def first_visits(keys):
+    """
+    Returns the indices at which each distinct key first appears.
+    """
+    _, indices = np.unique(keys, return_index=True)
+    return indices
+
+
+def one_episode_state_action_values(environment, policy, random_start=True, gamma=1.0):
+    """
+    Plays one episode and returns the state, action and return of the first
+    visit to every state-action pair, as three arrays.
+    """
+    s = environment.get_starting_state()
+    (states, actions, rewards) = generate_episode(environment, policy, s, random_first_action=random_start)
+    return _first_visit_returns(environment, states, actions, rewards, gamma)
+
+
+def _first_visit_returns(environment, states, actions, rewards, gamma):
+    gains = discounted_returns(rewards, gamma)
+    first = first_visits(states * environment.num_actions() + actions)
+    return states[first], actions[first], gains[first]
 
 
 def on_policy_fv_mc_e_soft_control(
@@ -84,25 +202,58 @@ def on_policy_fv_mc_e_soft_control(
         epsilon_func=lambda ep, eps: 0.1,
         alpha_func=lambda n: 0.1,
         episodes=10000,
-        random_start=False
+        random_start=False,
+        checkpoint=None,
+        checkpoint_every=1000,
+        resume=False,
+        compress=True
     ):
+    """
+    If checkpoint is a path, the policy, Q, N, the episode counter and the
+    random state are saved there every checkpoint_every episodes. With
+    resume=True training carries on from the checkpoint instead of
+    starting over, or starts over if there's no checkpoint file yet.
+    compress=False stores checkpoints uncompressed, so
+    resuming memory-maps the tables (see lib.checkpoint).
+
+    Episodes are played in lib.kernels when it can, which reseeds its
+    random generator every checkpoint_every episodes, checkpoint or not.
+    """
     # Initialize with uniform random policy
 
     policy = (1/environment.num_actions()) * np.ones((environment.num_states(), environment.num_actions()))
 
     Q = np.zeros((environment.num_states(), environment.num_actions()))
     N = np.zeros((environment.num_states(), environment.num_actions()))
-
-    for episode in range(episodes):
-        states_seen = one_episode_state_action_values(environment, lambda s: sample_action(policy, s), random_start=random_start)
-        for state, actions_performed in states_seen.items():
-            for action, gain in actions_performed.items():
-                N[state, action] = N[state, action] + 1
-                Q[state, action] = Q[state, action] + alpha_func(N[state, action])*(gain - Q[state, action])
-            epsilon = epsilon_func(episode, episodes)
-            num_actions = Q.shape[1]
-            policy[state] = (epsilon/num_actions)
-            policy[state, np.argmax(Q[state])] += 1 - epsilon
+    start = 0
+    saved = resume_checkpoint(checkpoint) if resume else None
+    if saved is not None:
+        (policy, Q, N, start) = (saved['policy'], saved['Q'], saved['N'], saved['episode'])
+
+    tables = kernels.environment_tables(environment)
+    if tables is not None:
+        kernels.seed(np.random.randint(2**31))
+
+    for episode in range(start, episodes):
+        if tables is not None:
+            (states, actions, rewards) = kernels.soft_policy_episode(*tables, np.asarray(policy), random_start)
+            (states, actions, gains) = _first_visit_returns(environment, states, actions, rewards, 1.0)
+        else:
+            (states, actions, gains) = one_episode_state_action_values(environment, lambda s: sample_action(policy, s), random_start=random_start)
+        N[states, actions] = N[states, actions] + 1
+        Q[states, actions] = Q[states, actions] + alpha_func(N[states, actions])*(gains - Q[states, actions])
+
+        visited = np.unique(states)
+        epsilon = epsilon_func(episode, episodes)
+        num_actions = Q.shape[1]
+        policy[visited] = (epsilon/num_actions)
+        policy[visited, np.argmax(Q[visited], axis=1)] += 1 - epsilon
+
+        if checkpoint is not None and ((episode + 1) % checkpoint_every == 0 or episode + 1 == episodes):
+            save_checkpoint(checkpoint, Q, N, episode + 1, compress, policy=policy)
+        if tables is not None and (episode + 1) % checkpoint_every == 0:
+            # Reseed wherever a checkpoint could be, so resumed runs match
+            kernels.seed(np.random.randint(2**31))
 
     return policy, Q
 
@@ -117,16 +268,14 @@ def det_fv_policy_q_evaluation(environment, policy, episodes=10000):
     N = np.zeros((environment.num_states(), environment.num_actions()))
 
     for episode in tqdm(range(episodes)):
-        states_seen = one_episode_state_action_values(environment, lambda s: policy[s], random_start=True)
-        for state, actions_performed in states_seen.items():
-            for action, gain in actions_performed.items():
-                N[state, action] = N[state, action] + 1
-                Q[state, action] = Q[state, action] + (1.0/(N[state, action]))*(gain - Q[state, action])
+        (states, actions, gains) = one_episode_state_action_values(environment, lambda s: policy[s], random_start=True)
+        N[states, actions] = N[states, actions] + 1
+        Q[states, actions] = Q[states, actions] + (1.0/(N[states, actions]))*(gains - Q[states, actions])
 
     return Q
 
 
-def fv_policy_evaluation(environment, policy, episodes=10000):
+def fv_policy_evaluation(environment, policy, episodes=10000, gamma=1.0):
     """
     First visit MC policy evaluation.
 
@@ -137,24 +286,84 @@ def fv_policy_evaluation(environment, policy, episodes=10000):
 
     for episode in tqdm(range(episodes)):
         s = environment.get_random_state()
-        states_seen = {}
-        episode_over = False
-        while not episode_over:
-            # If this is the first time we've seen this state
-            if states_seen.get(s, None) is None:
-                states_seen[s] = 0
-
-            # Perform our action
-            a = policy[s]
-            (r, s_prime, episode_over) = environment.perform_action(s, a)
-
-            # Update our gain counters
-            states_seen = {state: gain + r for state, gain in states_seen.items()}
-
-            # Update current state
-            s = s_prime
-        for state, gain in states_seen.items():
-            N[state] = N[state] + 1
-            V[state] = V[state] + (1.0/(N[state]))*(gain - V[state])
-
-    return V
\ No newline at end of file
+        (states, _, rewards) = generate_episode(environment, lambda s: policy[s], s)
+        gains = discounted_returns(rewards, gamma)
+        first = first_visits(states)
+        states = states[first]
+        N[states] = N[states] + 1
+        V[states] = V[states] + (1.0/(N[states]))*(gains[first] - V[states])
+
+    return V
+
+
+def off_policy_mc_control(environment, epsilon=0.1, episodes=10000, gamma=1.0):
+    """
+    Off-policy MC control with weighted importance sampling.
+
+    Episodes are played by a soft behaviour policy, epsilon greedy over Q,
+    while the target policy is greedy over Q. Each episode is processed
+    backwards once, stopping at the first action the target policy would
+    not have taken, since every earlier step then has importance ratio 0.
+
+    Returns the greedy target policy and Q.
+    """
+    Q = np.zeros((environment.num_states(), environment.num_actions()))
+    C = np.zeros((environment.num_states(), environment.num_actions()))
+    behaviour = EpsilonGreedyPolicy(Q, epsilon)
+    num_actions = environment.num_actions()
+
+    for episode in tqdm(range(episodes)):
+        s = environment.get_starting_state()
+        (states, actions, rewards) = generate_episode(environment, behaviour.sample_action, s)
+        # Q hasn't changed since the episode was played, so these are the
+        # probabilities the behaviour policy actually used
+        greedy = actions == np.argmax(Q[states], axis=1)
+        behaviour_probabilities = epsilon/num_actions + (1 - epsilon)*greedy
+
+        G = 0.0
+        W = 1.0
+        for t in range(len(states) - 1, -1, -1):
+            s = states[t]
+            a = actions[t]
+            G = gamma*G + rewards[t]
+            C[s, a] += W
+            Q[s, a] += (W/C[s, a])*(G - Q[s, a])
+            if a != np.argmax(Q[s]):
+                break
+            W = W/behaviour_probabilities[t]
+
+    return get_greedy_policy(Q), Q
+
+
+def off_policy_mc_q_evaluation(environment, target_policy, behaviour_policy, episodes=10000, gamma=1.0):
+    """
+    Off-policy MC action-value evaluation with weighted importance sampling.
+
+    Both policies are environment.num_states x environment.num_actions
+    arrays, and behaviour_policy must give every action the target policy
+    can take a non-zero probability. Each episode is processed backwards
+    once, stopping as soon as the importance ratio reaches 0.
+
+    Returns the action-value function of target_policy.
+    """
+    Q = np.zeros((environment.num_states(), environment.num_actions()))
+    C = np.zeros((environment.num_states(), environment.num_actions()))
+
+    for episode in tqdm(range(episodes)):
+        s = environment.get_starting_state()
+        (states, actions, rewards) = generate_episode(environment, lambda s: sample_action(behaviour_policy, s), s)
+        ratios = target_policy[states, actions] / behaviour_policy[states, actions]
+
+        G = 0.0
+        W = 1.0
+        for t in range(len(states) - 1, -1, -1):
+            s = states[t]
+            a = actions[t]
+            G = gamma*G + rewards[t]
+            C[s, a] += W
+            Q[s, a] += (W/C[s, a])*(G - Q[s, a])
+            W = W*ratios[t]
+            if W == 0:
+                break
+
+    return Q
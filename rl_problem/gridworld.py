@@ -1,5 +1,8 @@
 import numpy as np
-from itertools import product
+import scipy.sparse
+import scipy.sparse.linalg
+
+from lib.mdp import TabularMDP
 
 
 class GridWorld:
@@ -9,15 +12,24 @@ class GridWorld:
     DOWN = 2
     LEFT = 3
 
-    def __init__(self, size=5):
+    def __init__(self, size=5, sparse=False):
+        """
+        :param sparse: Store transitions as one size**2 x size**2 CSR matrix per
+                       action instead of a dense (4, size, size, size, size)
+                       array. Needed for anything but small grids.
+        """
         self.size = size
+        self.sparse = sparse
         self.action_space = [self.UP, self.RIGHT, self.DOWN, self.LEFT]
         self.A = (0, 1)
         self.A_prime = (4, 1)
         self.B = (0, 3)
         self.B_prime = (2, 3)
         self._rewards = self._init_rewards()
-        self._transitions = self._init_state_transitions()
+        if sparse:
+            self._transitions = self._init_sparse_state_transitions()
+        else:
+            self._transitions = self._init_state_transitions()
 
     def get_uniform_policy(self):
         policy = np.zeros((4, self.size, self.size))
@@ -67,38 +79,189 @@ class GridWorld:
 
         return state_transitions
 
-    def get_value_function(self, policy, gamma=0.9):
+    def _init_sparse_state_transitions(self):
+        """
+        Returns a list with one size**2 x size**2 CSR matrix per action.
+        Every state has exactly one next state, so each row holds a single 1.
+        """
+        states = np.arange(self.size**2)
+        rows, cols = np.divmod(states, self.size)
+        next_cells = {
+            self.UP: (np.maximum(rows - 1, 0), cols),
+            self.RIGHT: (rows, np.minimum(cols + 1, self.size - 1)),
+            self.DOWN: (np.minimum(rows + 1, self.size - 1), cols),
+            self.LEFT: (rows, np.maximum(cols - 1, 0)),
+        }
+        transitions = []
+        for action in self.action_space:
+            next_rows, next_cols = next_cells[action]
+            next_states = next_rows * self.size + next_cols
+            # Handle A and B
+            next_states[self.A[0]*self.size + self.A[1]] = self.A_prime[0]*self.size + self.A_prime[1]
+            next_states[self.B[0]*self.size + self.B[1]] = self.B_prime[0]*self.size + self.B_prime[1]
+            transitions.append(scipy.sparse.csr_matrix(
+                (np.ones(self.size**2), (states, next_states)),
+                shape=(self.size**2, self.size**2)
+            ))
+        return transitions
+
+    def to_mdp(self, gamma=0.9):
+        """
+        Returns the grid as a TabularMDP. State row * size + col is the cell
+        at (row, col), and actions are UP, RIGHT, DOWN, LEFT. A (4, size, size)
+        policy converts with policy.reshape(4, -1).T.
+        """
+        return TabularMDP(
+            self._transition_matrices(),
+            self._rewards.reshape(4, self.size**2).T,
+            gamma=gamma
+        )
+
+    def get_value_function(self, policy, gamma=0.9, solver='direct'):
+        """
+        :param solver: 'direct' solves the linear system exactly. 'iterative'
+                       uses BiCGSTAB, which needs far less memory on large
+                       sparse grids.
+        """
         # Solve V = R + gamma*P(s,s')*V
         transition_probabilities = self.get_transition_probabilities(policy)
         expected_rewards = self.get_expected_rewards(policy).reshape(self.size**2)
-        right_side_inverse = np.linalg.inv(np.identity(self.size**2) - gamma*transition_probabilities)
-        return np.matmul(right_side_inverse, expected_rewards)
+        if not self.sparse:
+            right_side_inverse = np.linalg.inv(np.identity(self.size**2) - gamma*transition_probabilities)
+            return np.matmul(right_side_inverse, expected_rewards)
+
+        system = (scipy.sparse.identity(self.size**2, format='csr') - gamma*transition_probabilities).tocsc()
+        if solver == 'direct':
+            return scipy.sparse.linalg.spsolve(system, expected_rewards)
+        elif solver == 'iterative':
+            value, info = scipy.sparse.linalg.bicgstab(system, expected_rewards)
+            if info != 0:
+                raise RuntimeError(f'Policy evaluation did not converge (info={info})')
+            return value
+        else:
+            raise ValueError('Solver must be direct or iterative')
 
     def get_transition_probabilities(self, policy):
+        if self.sparse:
+            ret = scipy.sparse.csr_matrix((self.size**2, self.size**2))
+            for action in self.action_space:
+                # p(a|s) * p(s'|s, a)
+                action_policy = scipy.sparse.diags(policy[action, :, :].reshape(self.size**2))
+                ret = ret + action_policy @ self._transitions[action]
+            return ret
+
         ret = np.zeros((self.size**2, self.size**2))
         for action in self.action_space:
             # p(a|s)
-            action_policy = np.tile(policy[action, :, :].reshape(self.size**2), (self.size**2, 1))
+            action_policy = policy[action, :, :].reshape(self.size**2, 1)
             # p(s'|s, a)
             state_transitions = self._transitions[action, :, :, :, :].reshape(self.size**2, self.size**2)
             ret = np.add(ret, np.multiply(action_policy, state_transitions))
         return ret
 
-    def get_optimal_value_function(self, gamma=0.9, convergence=0.01):
+    def _transition_matrices(self):
+        """
+        Returns the transitions as one size**2 x size**2 CSR matrix per action,
+        whichever backend is in use.
+        """
+        if self.sparse:
+            return self._transitions
+        if getattr(self, '_csr_transitions', None) is None:
+            self._csr_transitions = [
+                scipy.sparse.csr_matrix(self._transitions[action].reshape(self.size**2, self.size**2))
+                for action in self.action_space
+            ]
+        return self._csr_transitions
+
+    def _action_values(self, value, gamma, states=None):
+        """
+        Backs up every action at once. Returns a 4 x len(states) array of
+        R(s, a) + gamma * sum_s' p(s'|s, a) V(s'). states defaults to all of them.
+        """
+        rewards = self._rewards.reshape(4, self.size**2)
+        transitions = self._transition_matrices()
+        if states is None:
+            return np.stack([rewards[a] + gamma*(transitions[a] @ value) for a in self.action_space])
+        return np.stack([rewards[a, states] + gamma*(transitions[a][states] @ value) for a in self.action_space])
+
+    def get_greedy_policy(self, value, gamma=0.9):
+        """
+        Returns the deterministic policy that is greedy with respect to value,
+        as a (4, size, size) array like get_uniform_policy.
+        """
+        best_actions = np.argmax(self._action_values(value, gamma), axis=0)
+        policy = np.zeros((4, self.size**2))
+        policy[best_actions, np.arange(self.size**2)] = 1
+        return policy.reshape(4, self.size, self.size)
+
+    def get_optimal_value_function(self, gamma=0.9, convergence=0.01, method='synchronous',
+                                   batch_size=None, return_policy=False):
+        """
+        Value iteration.
+
+        :param method: 'synchronous' backs up every state from the last sweep's
+                       values. 'gauss_seidel' updates the two colours of a
+                       checkerboard in turn, so half of each sweep already sees
+                       new values. 'prioritized' repeatedly backs up the
+                       batch_size states with the largest Bellman error and then
+                       refreshes the error of their predecessors.
+        :param batch_size: States per prioritized backup. Defaults to 1% of the grid.
+        :param return_policy: Also return the greedy policy
+        """
+        if method == 'synchronous':
+            ret = self._synchronous_value_iteration(gamma, convergence)
+        elif method == 'gauss_seidel':
+            ret = self._gauss_seidel_value_iteration(gamma, convergence)
+        elif method == 'prioritized':
+            ret = self._prioritized_value_iteration(gamma, convergence, batch_size)
+        else:
+            raise ValueError('Method must be synchronous, gauss_seidel or prioritized')
+        if return_policy:
+            return ret, self.get_greedy_policy(ret, gamma)
+        return ret
+
+    def _synchronous_value_iteration(self, gamma, convergence):
         ret = np.zeros(self.size**2)
-        copy = np.copy(ret)
         diff = None
         while diff is None or diff > convergence:
-            for row, col in product(range(self.size), range(self.size)):
-                new_reward = None
-                for action in self.action_space:
-                    next_state_distribution = self._transitions[action, row, col].reshape(self.size**2)
-                    expected_rewards = np.matmul(next_state_distribution, ret)
-                    test = self._rewards[action, row, col] + gamma*expected_rewards
-                    if new_reward is None or test > new_reward:
-                        new_reward = test
-                copy[row*self.size + col] = new_reward
+            copy = np.max(self._action_values(ret, gamma), axis=0)
             diff = np.sum(np.fabs(np.subtract(ret, copy)))
             ret = copy
+        return ret
+
+    def _gauss_seidel_value_iteration(self, gamma, convergence):
+        rows, cols = np.divmod(np.arange(self.size**2), self.size)
+        rewards = self._rewards.reshape(4, self.size**2)
+        # Slice out each colour's rows once rather than on every sweep
+        colours = []
+        for colour in (0, 1):
+            states = np.flatnonzero((rows + cols) % 2 == colour)
+            colours.append((states, rewards[:, states], [t[states] for t in self._transition_matrices()]))
+        ret = np.zeros(self.size**2)
+        diff = None
+        while diff is None or diff > convergence:
             copy = np.copy(ret)
+            for states, colour_rewards, colour_transitions in colours:
+                ret[states] = np.max(
+                    [colour_rewards[a] + gamma*(colour_transitions[a] @ ret) for a in self.action_space],
+                    axis=0
+                )
+            diff = np.sum(np.fabs(np.subtract(ret, copy)))
+        return ret
+
+    def _prioritized_value_iteration(self, gamma, convergence, batch_size):
+        num_states = self.size**2
+        if batch_size is None:
+            batch_size = max(1, num_states // 100)
+        batch_size = min(batch_size, num_states)
+        # Row s' lists every state that can move into s'
+        predecessors = sum(transitions.T for transitions in self._transition_matrices()).tocsr()
+
+        ret = np.zeros(num_states)
+        errors = np.fabs(np.max(self._action_values(ret, gamma), axis=0) - ret)
+        while np.sum(errors) > convergence:
+            states = np.argpartition(errors, -batch_size)[-batch_size:]
+            ret[states] = np.max(self._action_values(ret, gamma, states), axis=0)
+            affected = np.union1d(states, predecessors[states].indices)
+            errors[affected] = np.fabs(np.max(self._action_values(ret, gamma, affected), axis=0) - ret[affected])
         return ret
@@ -0,0 +1,37 @@
+from environments.racing.policy_file import save_policy
+from environments.racing.racing import RaceTrack
+from td_learning import td
+import argparse
+
+
+parser = argparse.ArgumentParser(description='n-step Sarsa Racetrack Policy Improvement')
+
+parser.add_argument('racetrack',
+                    type=str,
+                    help='Path to racetrack csv file')
+parser.add_argument('policy',
+                    type=str,
+                    help='Path at which to save policy file')
+parser.add_argument('--n',
+                    type=int,
+                    help='Number of steps of rewards to update from',
+                    default=4)
+parser.add_argument('--episodes',
+                    type=int,
+                    help='Number of episodes to train over',
+                    default=1000)
+parser.add_argument('--compact',
+                    action='store_true',
+                    help='Only index states a car can be in, to shrink Q')
+args = parser.parse_args()
+
+racetrack = RaceTrack(args.racetrack, compiled=True, compact=args.compact)
+policy, Q = td.n_step_sarsa(
+    racetrack,
+    n=args.n,
+    alpha_func=lambda n: 1/n,
+    epsilon_func=lambda ep, eps: 1 - (ep/eps),
+    episodes=args.episodes
+)
+
+save_policy(args.policy, policy, racetrack)
@@ -1,6 +1,6 @@
+from environments.racing.policy_file import save_policy
 from environments.racing.racing import RaceTrack
 from td_learning import td
-import numpy as np
 import argparse
 
 
@@ -20,14 +20,49 @@ parser.add_argument('--verbose',
                     type=bool,
                     help='Print (a lot of) log messages',
                     default=False)
+parser.add_argument('--cars',
+                    type=int,
+                    help='Number of cars to train with side by side',
+                    default=1)
+parser.add_argument('--checkpoint',
+                    type=str,
+                    help='Path at which to periodically save a training checkpoint',
+                    default=None)
+parser.add_argument('--checkpoint-every',
+                    type=int,
+                    help='Number of episodes between checkpoints',
+                    default=1000)
+parser.add_argument('--resume',
+                    action='store_true',
+                    help='Resume training from the checkpoint, if it exists')
+parser.add_argument('--no-compress',
+                    action='store_true',
+                    help='Store checkpoints uncompressed, so resuming memory-maps Q and N; '
+                         'recommended for large tracks')
+parser.add_argument('--compact',
+                    action='store_true',
+                    help='Only index states a car can be in, to shrink Q')
 args = parser.parse_args()
 
-racetrack = RaceTrack(args.racetrack)
-policy, Q = td.q_learning(
-    racetrack,
-    alpha_func=lambda n: 1/n,
-    epsilon=0.2,
-    convergence=args.convergence
-)
+racetrack = RaceTrack(args.racetrack, compiled=True, compact=args.compact)
+if args.cars > 1:
+    policy, Q = td.q_learning_batch(
+        racetrack,
+        alpha_func=lambda n: 1/n,
+        epsilon=0.2,
+        convergence=args.convergence,
+        num_envs=args.cars
+    )
+else:
+    policy, Q = td.q_learning(
+        racetrack,
+        alpha_func=lambda n: 1/n,
+        epsilon=0.2,
+        convergence=args.convergence,
+        checkpoint=args.checkpoint,
+        checkpoint_every=args.checkpoint_every,
+        resume=args.resume,
+        compress=not args.no_compress
+    )
 
-np.save(args.policy, policy)
+save_policy(args.policy, policy, racetrack)
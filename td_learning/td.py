@@ -8,66 +8,631 @@ An environment is assumed to support the following operations:
     environment.perform_action(a): Returns a reward, the next state (r, s'), and whether
                                    the episode is over
 
+The batched learners (sarsa_batch, q_learning_batch) also need:
+    environment.get_starting_states(n): Returns an array of n starting states
+    environment.step_batch(s, a): perform_action for arrays of states and actions,
+                                  resetting every episode that ends
+
 A deterministic policy is a environment.num_states x 1 array
 A non-deterministic policy is a environment.num_states x environment.num_actions array
 """
 import numpy as np
 from tqdm import tqdm
 
-from lib.policy import sample_action, get_epsilon_greedy_policy
+from lib import kernels
+from lib.checkpoint import resume_checkpoint, save_checkpoint
+from lib.model import PairQueue, TabularModel
+from lib.policy import EpsilonGreedyPolicy, get_epsilon_greedy_policy, sample_action
+from lib.traces import EligibilityTraces
+from lib.trajectory import TrajectoryBuffer
 
 def sarsa(
         environment,
         epsilon_func=lambda ep, eps: 0.1,
         alpha_func=lambda n: 0.1,
-        episodes=10000
+        episodes=10000,
+        checkpoint=None,
+        checkpoint_every=1000,
+        resume=False,
+        compress=True
     ):
+    """
+    If checkpoint is a path, Q, N, the episode counter and the random state
+    are saved there every checkpoint_every episodes. With resume=True
+    training carries on from the checkpoint instead of starting over, or
+    starts over if there's no checkpoint file yet. compress=False stores
+    checkpoints uncompressed, so resuming memory-maps Q and N (see
+    lib.checkpoint).
+
+    Runs in lib.kernels when it can. The kernels reseed every
+    checkpoint_every episodes even without a checkpoint, so there
+    checkpoint_every affects the results too.
+    """
     Q = np.zeros((environment.num_states(), environment.num_actions()))
     N = np.zeros((environment.num_states(), environment.num_actions()))
-    policy = get_epsilon_greedy_policy(Q, (1.0/environment.num_actions()))
-    for ep in tqdm(range(episodes)):
+    start = 0
+    saved = resume_checkpoint(checkpoint) if resume else None
+    if saved is not None:
+        (Q, N, start) = (saved['Q'], saved['N'], saved['episode'])
+    policy = EpsilonGreedyPolicy(Q, (1.0/environment.num_actions()))
+    if start > 0:
+        # The first action of an episode uses the epsilon the previous
+        # episode's last step left behind
+        policy.epsilon = epsilon_func(start - 1, episodes)
+
+    tables = kernels.environment_tables(environment)
+    if tables is not None:
+        policy.epsilon = _sarsa_kernel(
+            tables, Q, N, epsilon_func, alpha_func, start, episodes, checkpoint, checkpoint_every, compress,
+            policy.epsilon
+        )
+        return policy.to_matrix(), Q
+
+    for ep in tqdm(range(start, episodes), initial=start, total=episodes):
         episode_over = False
         s = environment.get_starting_state()
-        a = sample_action(policy, s)
+        a = policy.sample_action(s)
         while not episode_over:
             (r, s_prime, episode_over) = environment.perform_action(s, a)
 
             N[s, a] = N[s, a] + 1
 
-            policy = get_epsilon_greedy_policy(Q, epsilon_func(ep, episodes))
-            a_prime = sample_action(policy, s)
+            policy.epsilon = epsilon_func(ep, episodes)
+            a_prime = policy.sample_action(s_prime)
 
             Q[s, a] = Q[s, a] + alpha_func(N[s, a]) * (r + Q[s_prime, a_prime] - Q[s, a])
 
             s = s_prime
             a = a_prime
-    return policy, Q
+
+        if checkpoint is not None and ((ep + 1) % checkpoint_every == 0 or ep + 1 == episodes):
+            save_checkpoint(checkpoint, Q, N, ep + 1, compress)
+    return policy.to_matrix(), Q
+
+def _sarsa_kernel(tables, Q, N, epsilon_func, alpha_func, start, episodes, checkpoint, checkpoint_every, compress,
+                  epsilon):
+    """
+    Runs sarsa's episodes in kernels.sarsa_episodes, stopping every
+    checkpoint_every episodes to save a checkpoint and reseed the kernels.
+    Returns the final epsilon.
+    """
+    epsilons = np.array([epsilon_func(ep, episodes) for ep in range(episodes)], dtype=float)
+    alphas = kernels.alpha_table(alpha_func, int(np.max(N, initial=0)) + 1024)
+    (s, a, in_episode) = (0, 0, False)
+    episode = start
+    with tqdm(total=episodes, initial=start) as progress:
+        while episode < episodes:
+            stop = min((episode // checkpoint_every + 1) * checkpoint_every, episodes)
+            kernels.seed(np.random.randint(2**31))
+            while episode < stop:
+                (new_episode, epsilon, s, a, in_episode) = kernels.sarsa_episodes(
+                    *tables, np.asarray(Q), np.asarray(N), epsilons, alphas,
+                    episode, stop, epsilon, s, a, in_episode
+                )
+                progress.update(new_episode - episode)
+                episode = new_episode
+                if episode < stop:
+                    # Stopped because a visit count outgrew the step sizes
+                    alphas = kernels.alpha_table(alpha_func, 2 * len(alphas))
+            if checkpoint is not None:
+                save_checkpoint(checkpoint, Q, N, episode, compress)
+    return epsilon
 
 def q_learning(
         environment,
         epsilon=0.3,
         alpha_func=lambda n: 0.2,
-        convergence=0.1
+        convergence=0.1,
+        checkpoint=None,
+        checkpoint_every=1000,
+        resume=False,
+        compress=True
     ):
+    """
+    If checkpoint is a path, Q, N, the episode counter and the random state
+    are saved there every checkpoint_every episodes and after every
+    convergence check. With resume=True training carries on from the
+    checkpoint instead of starting over, or starts over if there's no
+    checkpoint file yet. compress is as in sarsa.
+
+    Runs in lib.kernels when it can. The kernels reseed every
+    checkpoint_every episodes even without a checkpoint, so there
+    checkpoint_every affects the results too.
+    """
     Q = np.zeros((environment.num_states(), environment.num_actions()))
     N = np.zeros((environment.num_states(), environment.num_actions()))
+    episode = 0
+    temp = np.copy(Q)
+    saved = resume_checkpoint(checkpoint) if resume else None
+    if saved is not None:
+        (Q, N, episode) = (saved['Q'], saved['N'], saved['episode'])
+        # Q as it was at the start of the interrupted block of episodes
+        temp = saved['Q_block']
+    policy = EpsilonGreedyPolicy(Q, epsilon)
+    tables = kernels.environment_tables(environment)
+    if tables is not None:
+        alphas = kernels.alpha_table(alpha_func, int(np.max(N, initial=0)) + 1024)
     diff = np.inf
     while diff > convergence:
-        temp = np.copy(Q)
         # Perform 10,000 episodes, then check how much q has changed
-        for ep in tqdm(range(10000)):
-            episode_over = False
-            s = environment.get_starting_state()
-            while not episode_over:
-                policy = get_epsilon_greedy_policy(Q, epsilon)
-                a = sample_action(policy, s)
+        if tables is not None:
+            (episode, alphas) = _q_learning_kernel_block(
+                tables, Q, N, epsilon, alpha_func, alphas, episode, temp, checkpoint, checkpoint_every, compress
+            )
+        else:
+            for ep in tqdm(range(episode % 10000, 10000), initial=episode % 10000, total=10000):
+                episode_over = False
+                s = environment.get_starting_state()
+                while not episode_over:
+                    a = policy.sample_action(s)
+
+                    (r, s_prime, episode_over) = environment.perform_action(s, a)
+
+                    N[s, a] = N[s, a] + 1
+                    Q[s, a] = Q[s, a] + alpha_func(N[s, a]) * (r + np.amax(Q[s_prime]) - Q[s, a])
+
+                    s = s_prime
+
+                episode += 1
+                # The end of a block is saved below, once temp has moved on
+                if checkpoint is not None and episode % checkpoint_every == 0 and episode % 10000 != 0:
+                    save_checkpoint(checkpoint, Q, N, episode, compress, Q_block=temp)
+        diff = np.sum(np.fabs(np.subtract(Q, temp)))
+        print(f'Diff: {diff}')
+        temp = np.copy(Q)
+        if checkpoint is not None:
+            save_checkpoint(checkpoint, Q, N, episode, compress, Q_block=temp)
+
+    return get_epsilon_greedy_policy(Q, 0.0), Q
+
+def _q_learning_kernel_block(tables, Q, N, epsilon, alpha_func, alphas, episode, temp, checkpoint, checkpoint_every,
+                             compress):
+    """
+    Runs the rest of q_learning's current block of 10,000 episodes in
+    kernels.q_learning_episodes, stopping every checkpoint_every episodes
+    to save a checkpoint and reseed the kernels.
+
+    Returns the episode counter, which is then at the end of the block, and
+    the step size table.
+    """
+    block_end = (episode // 10000 + 1) * 10000
+    (s, in_episode) = (0, False)
+    with tqdm(total=10000, initial=episode % 10000) as progress:
+        while episode < block_end:
+            stop = min((episode // checkpoint_every + 1) * checkpoint_every, block_end)
+            kernels.seed(np.random.randint(2**31))
+            while episode < stop:
+                (new_episode, s, in_episode) = kernels.q_learning_episodes(
+                    *tables, np.asarray(Q), np.asarray(N), epsilon, alphas, episode, stop, s, in_episode
+                )
+                progress.update(new_episode - episode)
+                episode = new_episode
+                if episode < stop:
+                    # Stopped because a visit count outgrew the step sizes
+                    alphas = kernels.alpha_table(alpha_func, 2 * len(alphas))
+            # The end of a block is saved by q_learning, once temp has moved on
+            if checkpoint is not None and episode % checkpoint_every == 0 and episode % 10000 != 0:
+                save_checkpoint(checkpoint, Q, N, episode, compress, Q_block=temp)
+    return episode, alphas
+
+def expected_sarsa(
+        environment,
+        epsilon_func=lambda ep, eps: 0.1,
+        alpha_func=lambda n: 0.1,
+        episodes=10000,
+        gamma=1.0
+    ):
+    """
+    Sarsa that bootstraps from the expected value of Q[s'] under the epsilon
+    greedy policy instead of from the one action sampled in s', which takes
+    the action sampling noise out of the targets.
+    """
+    Q = np.zeros((environment.num_states(), environment.num_actions()))
+    N = np.zeros((environment.num_states(), environment.num_actions()))
+    policy = EpsilonGreedyPolicy(Q, (1.0/environment.num_actions()))
+
+    for ep in tqdm(range(episodes)):
+        policy.epsilon = epsilon_func(ep, episodes)
+        episode_over = False
+        s = environment.get_starting_state()
+        while not episode_over:
+            a = policy.sample_action(s)
+            (r, s_prime, episode_over) = environment.perform_action(s, a)
+
+            N[s, a] = N[s, a] + 1
+
+            target = r
+            if not episode_over:
+                expected = policy.epsilon * np.mean(Q[s_prime]) + (1 - policy.epsilon) * np.amax(Q[s_prime])
+                target += gamma * expected
+            Q[s, a] = Q[s, a] + alpha_func(N[s, a]) * (target - Q[s, a])
+
+            s = s_prime
+    return policy.to_matrix(), Q
+
+def n_step_sarsa(
+        environment,
+        n=4,
+        epsilon_func=lambda ep, eps: 0.1,
+        alpha_func=lambda n: 0.1,
+        episodes=10000,
+        gamma=1.0
+    ):
+    """
+    Sarsa that updates Q[s, a] towards the rewards of the next n steps plus
+    the discounted Q of the state and action n steps later. n=1 is sarsa.
 
+    The last n steps are kept in a TrajectoryBuffer, so a step costs the
+    same whatever n is.
+    """
+    Q = np.zeros((environment.num_states(), environment.num_actions()))
+    N = np.zeros((environment.num_states(), environment.num_actions()))
+    policy = EpsilonGreedyPolicy(Q, (1.0/environment.num_actions()))
+    trajectory = TrajectoryBuffer(n, gamma)
+
+    for ep in tqdm(range(episodes)):
+        policy.epsilon = epsilon_func(ep, episodes)
+        trajectory.clear()
+        episode_over = False
+        s = environment.get_starting_state()
+        a = policy.sample_action(s)
+        while not episode_over or len(trajectory) > 0:
+            if not episode_over:
+                (r, s_prime, episode_over) = environment.perform_action(s, a)
+                trajectory.append(s, a, r)
+                s = s_prime
+                if not episode_over:
+                    a = policy.sample_action(s)
+
+            # Update the oldest step once it has n steps of rewards, or
+            # flush the remaining steps once the episode is over
+            if len(trajectory) == n or episode_over:
+                (s_tau, a_tau) = trajectory.oldest()
+                target = trajectory.reward_sum()
+                if not episode_over:
+                    target += gamma**n * Q[s, a]
+                N[s_tau, a_tau] = N[s_tau, a_tau] + 1
+                Q[s_tau, a_tau] = Q[s_tau, a_tau] + alpha_func(N[s_tau, a_tau]) * (target - Q[s_tau, a_tau])
+                trajectory.pop_oldest()
+    return policy.to_matrix(), Q
+
+def n_step_td_prediction(
+        environment,
+        policy,
+        n=4,
+        alpha_func=lambda n: 0.1,
+        episodes=10000,
+        gamma=1.0
+    ):
+    """
+    Estimates the state values of a non-deterministic policy, updating V[s]
+    towards the rewards of the next n steps plus the discounted value of the
+    state n steps later. n=1 is TD(0).
+    """
+    V = np.zeros(environment.num_states())
+    N = np.zeros(environment.num_states())
+    trajectory = TrajectoryBuffer(n, gamma)
+
+    for ep in tqdm(range(episodes)):
+        trajectory.clear()
+        episode_over = False
+        s = environment.get_starting_state()
+        while not episode_over or len(trajectory) > 0:
+            if not episode_over:
+                a = sample_action(policy, s)
                 (r, s_prime, episode_over) = environment.perform_action(s, a)
+                trajectory.append(s, a, r)
+                s = s_prime
+
+            if len(trajectory) == n or episode_over:
+                (s_tau, _) = trajectory.oldest()
+                target = trajectory.reward_sum()
+                if not episode_over:
+                    target += gamma**n * V[s]
+                N[s_tau] = N[s_tau] + 1
+                V[s_tau] = V[s_tau] + alpha_func(N[s_tau]) * (target - V[s_tau])
+                trajectory.pop_oldest()
+    return V
+
+def sarsa_lambda(
+        environment,
+        lam=0.9,
+        epsilon_func=lambda ep, eps: 0.1,
+        alpha_func=lambda n: 0.1,
+        episodes=10000,
+        gamma=1.0,
+        replacing=True,
+        threshold=1e-3
+    ):
+    """
+    Sarsa(lambda), which spreads every TD error back over the recently
+    visited pairs through their eligibility traces.
+
+    Traces are replacing or, with replacing=False, accumulating, and are
+    forgotten once they decay below threshold. Each update's step size is
+    alpha_func of the visit count of the pair just visited.
+    """
+    Q = np.zeros((environment.num_states(), environment.num_actions()))
+    N = np.zeros((environment.num_states(), environment.num_actions()))
+    policy = EpsilonGreedyPolicy(Q, (1.0/environment.num_actions()))
+    traces = EligibilityTraces(Q.shape, gamma * lam, threshold, replacing)
+
+    for ep in tqdm(range(episodes)):
+        policy.epsilon = epsilon_func(ep, episodes)
+        traces.clear()
+        episode_over = False
+        s = environment.get_starting_state()
+        a = policy.sample_action(s)
+        while not episode_over:
+            (r, s_prime, episode_over) = environment.perform_action(s, a)
+
+            N[s, a] = N[s, a] + 1
+
+            delta = r - Q[s, a]
+            if not episode_over:
+                a_prime = policy.sample_action(s_prime)
+                delta += gamma * Q[s_prime, a_prime]
+
+            traces.visit(s, a)
+            traces.update(Q, alpha_func(N[s, a]) * delta)
+            traces.decay()
+
+            if not episode_over:
+                s = s_prime
+                a = a_prime
+    return policy.to_matrix(), Q
+
+def q_lambda(
+        environment,
+        lam=0.9,
+        epsilon_func=lambda ep, eps: 0.1,
+        alpha_func=lambda n: 0.1,
+        episodes=10000,
+        gamma=1.0,
+        replacing=True,
+        threshold=1e-3
+    ):
+    """
+    Watkins's Q(lambda): Q-learning with eligibility traces, which are cut
+    whenever the behaviour policy takes an exploratory action. Traces work
+    as in sarsa_lambda.
+    """
+    Q = np.zeros((environment.num_states(), environment.num_actions()))
+    N = np.zeros((environment.num_states(), environment.num_actions()))
+    policy = EpsilonGreedyPolicy(Q, (1.0/environment.num_actions()))
+    traces = EligibilityTraces(Q.shape, gamma * lam, threshold, replacing)
+
+    for ep in tqdm(range(episodes)):
+        policy.epsilon = epsilon_func(ep, episodes)
+        traces.clear()
+        episode_over = False
+        s = environment.get_starting_state()
+        a = policy.sample_action(s)
+        while not episode_over:
+            (r, s_prime, episode_over) = environment.perform_action(s, a)
+
+            N[s, a] = N[s, a] + 1
+
+            delta = r - Q[s, a]
+            greedy = True
+            if not episode_over:
+                a_prime = policy.sample_action(s_prime)
+                best = np.amax(Q[s_prime])
+                greedy = Q[s_prime, a_prime] == best
+                delta += gamma * best
 
-                N[s, a] = N[s, a] + 1
-                Q[s, a] = Q[s, a] + alpha_func(N[s, a]) * (r + np.amax(Q[s_prime]) - Q[s, a])
+            traces.visit(s, a)
+            traces.update(Q, alpha_func(N[s, a]) * delta)
+            if greedy:
+                traces.decay()
+            else:
+                traces.clear()
 
+            if not episode_over:
                 s = s_prime
+                a = a_prime
+    return get_epsilon_greedy_policy(Q, 0.0), Q
+
+def dyna_q(
+        environment,
+        planning_steps=10,
+        epsilon_func=lambda ep, eps: 0.1,
+        alpha_func=lambda n: 0.1,
+        episodes=10000,
+        gamma=1.0
+    ):
+    """
+    Dyna-Q: Q-learning that also remembers every transition in a
+    TabularModel and, after each real step, replays planning_steps
+    transitions drawn from it.
+
+    The transitions are drawn from the model together, but backed up one
+    after another, so every one of the planning_steps updates happens and
+    each sees the ones before it.
+    """
+    Q = np.zeros((environment.num_states(), environment.num_actions()))
+    N = np.zeros((environment.num_states(), environment.num_actions()))
+    policy = EpsilonGreedyPolicy(Q, (1.0/environment.num_actions()))
+    model = TabularModel(Q.shape)
+
+    for ep in tqdm(range(episodes)):
+        policy.epsilon = epsilon_func(ep, episodes)
+        episode_over = False
+        s = environment.get_starting_state()
+        while not episode_over:
+            a = policy.sample_action(s)
+            (r, s_prime, episode_over) = environment.perform_action(s, a)
+
+            N[s, a] = N[s, a] + 1
+            target = r if episode_over else r + gamma * np.amax(Q[s_prime])
+            Q[s, a] = Q[s, a] + alpha_func(N[s, a]) * (target - Q[s, a])
+            model.update(s, a, r, s_prime, episode_over)
+
+            if planning_steps > 0:
+                for (s_plan, a_plan, r_plan, s_plan_prime, done) in zip(*model.sample(planning_steps)):
+                    target = r_plan if done else r_plan + gamma * np.amax(Q[s_plan_prime])
+                    step = alpha_func(N[s_plan, a_plan])
+                    Q[s_plan, a_plan] = Q[s_plan, a_plan] + step * (target - Q[s_plan, a_plan])
+
+            s = s_prime
+    return get_epsilon_greedy_policy(Q, 0.0), Q
+
+def prioritized_sweeping(
+        environment,
+        planning_steps=10,
+        theta=1e-4,
+        epsilon_func=lambda ep, eps: 0.1,
+        alpha_func=lambda n: 0.1,
+        episodes=10000,
+        gamma=1.0
+    ):
+    """
+    Dyna-Q that plans by priority instead of at random. Pairs whose TD error
+    is above theta are queued by the size of the error, and each real step
+    backs up to planning_steps of the worst ones. Backing up a pair queues
+    the pairs that lead to its state, found through the model's
+    predecessor index.
+
+    As in Sutton and Barto, real steps only update Q through the queue, so
+    planning_steps must be at least 1.
+    """
+    if planning_steps < 1:
+        raise ValueError(f'prioritized_sweeping needs planning_steps of at least 1, got {planning_steps}')
+    Q = np.zeros((environment.num_states(), environment.num_actions()))
+    N = np.zeros((environment.num_states(), environment.num_actions()))
+    policy = EpsilonGreedyPolicy(Q, (1.0/environment.num_actions()))
+    model = TabularModel(Q.shape)
+    queue = PairQueue(Q.size)
+    num_actions = environment.num_actions()
+
+    for ep in tqdm(range(episodes)):
+        policy.epsilon = epsilon_func(ep, episodes)
+        episode_over = False
+        s = environment.get_starting_state()
+        while not episode_over:
+            a = policy.sample_action(s)
+            (r, s_prime, episode_over) = environment.perform_action(s, a)
+
+            N[s, a] = N[s, a] + 1
+            model.update(s, a, r, s_prime, episode_over)
+            target = r if episode_over else r + gamma * np.amax(Q[s_prime])
+            if abs(target - Q[s, a]) > theta:
+                queue.push(s * num_actions + a, abs(target - Q[s, a]))
+
+            for _ in range(planning_steps):
+                pair = queue.pop()
+                if pair is None:
+                    break
+                (s_plan, a_plan) = divmod(pair, num_actions)
+                target = model.rewards[pair]
+                if not model.done[pair]:
+                    target += gamma * np.amax(Q[model.next_states[pair]])
+                Q[s_plan, a_plan] = Q[s_plan, a_plan] + alpha_func(N[s_plan, a_plan]) * (target - Q[s_plan, a_plan])
+
+                predecessors = model.predecessors(s_plan)
+                errors = np.fabs(
+                    model.rewards[predecessors] + gamma * np.amax(Q[s_plan]) - Q.reshape(-1)[predecessors]
+                )
+                for (predecessor, error) in zip(predecessors[errors > theta], errors[errors > theta]):
+                    queue.push(predecessor, error)
+
+            s = s_prime
+    return get_epsilon_greedy_policy(Q, 0.0), Q
+
+def _batch_update(Q, N, s, a, target, alpha_func):
+    """
+    Moves Q towards target for arrays of states and actions, averaging the
+    TD errors of repeated pairs so each pair takes one alpha step, however
+    many episodes visited it.
+    """
+    (pairs, inverse, counts) = np.unique(s * Q.shape[1] + a, return_inverse=True, return_counts=True)
+    errors = np.zeros(len(pairs))
+    np.add.at(errors, inverse, target - Q[s, a])
+    (states, actions) = np.divmod(pairs, Q.shape[1])
+    Q[states, actions] += alpha_func(N[states, actions]) * errors / counts
+
+def sarsa_batch(
+        environment,
+        epsilon_func=lambda ep, eps: 0.1,
+        alpha_func=lambda n: 0.1,
+        episodes=10000,
+        num_envs=1000
+    ):
+    """
+    Sarsa over num_envs episodes played side by side with
+    environment.step_batch. Training stops once episodes episodes have
+    finished in total.
+
+    alpha_func is called with an array of visit counts. When several
+    episodes update the same pair in one step, their TD errors are averaged
+    into a single step.
+    """
+    Q = np.zeros((environment.num_states(), environment.num_actions()))
+    N = np.zeros((environment.num_states(), environment.num_actions()))
+    policy = EpsilonGreedyPolicy(Q, (1.0/environment.num_actions()))
+    s = environment.get_starting_states(num_envs)
+    a = policy.sample_actions(s)
+    finished = 0
+    with tqdm(total=episodes) as progress:
+        while finished < episodes:
+            (r, s_prime, episode_over) = environment.step_batch(s, a)
+
+            np.add.at(N, (s, a), 1)
+
+            policy.epsilon = epsilon_func(finished, episodes)
+            a_prime = policy.sample_actions(s_prime)
+
+            # Finished episodes have already been reset, so don't bootstrap from s_prime
+            target = r + np.where(episode_over, 0.0, Q[s_prime, a_prime])
+            _batch_update(Q, N, s, a, target, alpha_func)
+
+            s = s_prime
+            a = a_prime
+
+            num_finished = min(int(np.count_nonzero(episode_over)), episodes - finished)
+            finished += num_finished
+            progress.update(num_finished)
+    return policy.to_matrix(), Q
+
+def q_learning_batch(
+        environment,
+        epsilon=0.3,
+        alpha_func=lambda n: 0.2,
+        convergence=0.1,
+        num_envs=1000
+    ):
+    """
+    Q-learning over num_envs episodes played side by side with
+    environment.step_batch. Like q_learning, it checks how much Q has
+    changed after every 10,000 finished episodes.
+
+    alpha_func is called with an array of visit counts. When several
+    episodes update the same pair in one step, their TD errors are averaged
+    into a single step.
+    """
+    Q = np.zeros((environment.num_states(), environment.num_actions()))
+    N = np.zeros((environment.num_states(), environment.num_actions()))
+    policy = EpsilonGreedyPolicy(Q, epsilon)
+    s = environment.get_starting_states(num_envs)
+    diff = np.inf
+    while diff > convergence:
+        temp = np.copy(Q)
+        finished = 0
+        with tqdm(total=10000) as progress:
+            while finished < 10000:
+                a = policy.sample_actions(s)
+
+                (r, s_prime, episode_over) = environment.step_batch(s, a)
+
+                np.add.at(N, (s, a), 1)
+                target = r + np.where(episode_over, 0.0, np.amax(Q[s_prime], axis=1))
+                _batch_update(Q, N, s, a, target, alpha_func)
+
+                s = s_prime
+
+                num_finished = min(int(np.count_nonzero(episode_over)), 10000 - finished)
+                finished += num_finished
+                progress.update(num_finished)
         diff = np.sum(np.fabs(np.subtract(Q, temp)))
         print(f'Diff: {diff}')
 